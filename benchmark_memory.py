@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for Discord Mod Mail Bot
+
+Feeds the same synthetic gateway traffic (guilds, members, voice states and
+messages) into the bot's client state under each memory profile and reports
+the resident set size, so the effect of MEMORY_PROFILE=low can be measured
+without connecting to Discord.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+def get_rss_kb():
+    """Current resident set size of this process in KiB"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+    # Fall back to peak RSS where /proc isn't available
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def make_user(user_id):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None}
+
+def make_guild(guild_id, channels, members):
+    """Build a GUILD_CREATE payload"""
+    now = datetime.now(timezone.utc).isoformat()
+    member_ids = [guild_id * 100000 + index for index in range(members)]
+
+    return {
+        "id": str(guild_id),
+        "name": f"Guild {guild_id}",
+        "icon": None,
+        "owner_id": str(member_ids[0]),
+        "member_count": members,
+        "large": members > 250,
+        "features": [],
+        "emojis": [],
+        "stickers": [],
+        "roles": [{
+            "id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0,
+            "color": 0, "hoist": False, "managed": False, "mentionable": False,
+        }],
+        "channels": [
+            {"id": str(guild_id * 1000 + index), "type": 0, "name": f"channel-{index}", "position": index, "permission_overwrites": []}
+            for index in range(channels)
+        ],
+        "members": [
+            {"user": make_user(member_id), "roles": [], "joined_at": now, "deaf": False, "mute": False, "flags": 0}
+            for member_id in member_ids
+        ],
+        "voice_states": [
+            {"user_id": str(member_id), "channel_id": str(guild_id * 1000), "session_id": "x",
+             "deaf": False, "mute": False, "self_deaf": False, "self_mute": False, "suppress": False}
+            for member_id in member_ids[:members // 10]
+        ],
+    }
+
+def make_message(message_id, guild_id, channel_id, author_id):
+    """Build a MESSAGE_CREATE payload"""
+    return {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": make_user(author_id),
+        "member": {"roles": [], "joined_at": datetime.now(timezone.utc).isoformat(), "deaf": False, "mute": False, "flags": 0},
+        "content": "Hello, I need help with my account. " * 4,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+    }
+
+def run_profile(profile, guilds, channels, members, messages):
+    """Measure RSS for one profile (runs inside a fresh subprocess)"""
+    os.environ["MEMORY_PROFILE"] = profile
+    os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "modmail.db")
+    os.environ["LOG_LEVEL"] = "ERROR"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import gc
+    import bot
+
+    state = bot.bot._connection
+    state.dispatch = lambda *args, **kwargs: None
+
+    gc.collect()
+    baseline = get_rss_kb()
+
+    for guild_index in range(guilds):
+        guild_id = guild_index + 1
+        state._add_guild_from_data(make_guild(guild_id, channels, members))
+
+    for index in range(messages):
+        guild_id = index % guilds + 1
+        channel_id = guild_id * 1000 + index % channels
+        author_id = guild_id * 100000 + index % members
+        state.parse_message_create(make_message(10**9 + index, guild_id, channel_id, author_id))
+
+    gc.collect()
+    return {
+        "profile": profile,
+        "rss_kb": get_rss_kb() - baseline,
+        "cached_members": sum(len(guild.members) for guild in bot.bot.guilds),
+        "cached_messages": len(bot.bot.cached_messages),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare RSS of the default and low memory profiles")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--profile", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        print(json.dumps(run_profile(args.profile, args.guilds, args.channels, args.members, args.messages)))
+        return
+
+    # Run each profile in its own process so they don't share allocator state
+    results = []
+    for profile in ("default", "low"):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--profile", profile,
+             "--guilds", str(args.guilds), "--channels", str(args.channels),
+             "--members", str(args.members), "--messages", str(args.messages)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"Workload: {args.guilds} guilds x {args.channels} channels, {args.members} members each, {args.messages} messages\n")
+    print(f"{'Profile':<10}{'RSS growth':>14}{'Members':>10}{'Messages':>10}")
+    for result in results:
+        print(
+            f"{result['profile']:<10}{result['rss_kb'] / 1024:>11.1f} MB"
+            f"{result['cached_members']:>10}{result['cached_messages']:>10}"
+        )
+
+    default, low = results
+    if default["rss_kb"] > 0:
+        saved = default["rss_kb"] - low["rss_kb"]
+        print(f"\nLow memory profile saves {saved / 1024:.1f} MB ({saved / default['rss_kb']:.0%})")
+
+if __name__ == "__main__":
+    main()
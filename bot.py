@@ -1,21 +1,73 @@
 import discord
 from discord.ext import commands
+import aiohttp
 import sqlite3
 import os
+import sys
+import gzip
+import hashlib
+import time
+import inspect
 import asyncio
+import cProfile
+import shutil
+import logging
+import threading
+import tempfile
+import traceback
+from collections import Counter
 from datetime import datetime, timezone
 from dotenv import load_dotenv
+from structured_logging import setup_logging
 
 # Load environment variables
 load_dotenv()
 
-# Bot configuration
-intents = discord.Intents.default()
-intents.message_content = True
-intents.dm_messages = True
-intents.guilds = True
+setup_logging()
+log = logging.getLogger('modmail')
+
+def build_client_options(memory_profile='default'):
+    """Gateway intents and cache settings for a memory profile ('default' or 'low')"""
+    if memory_profile == 'low':
+        # Only subscribe to what mod mail uses: guild structure, guild messages and DMs
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
+        intents.dm_messages = True
+        intents.message_content = True
+
+        # Tickets are tracked in our own database, so discord.py's caches can stay empty.
+        # Members are fetched from the API when a command needs them, and edits and
+        # deletions of uncached messages arrive through the raw message events.
+        return {
+            'intents': intents,
+            'max_messages': None,
+            'member_cache_flags': discord.MemberCacheFlags.none(),
+            'chunk_guilds_at_startup': False,
+        }
+
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.dm_messages = True
+    intents.guilds = True
+
+    return {'intents': intents}
 
-bot = commands.Bot(command_prefix=os.getenv('BOT_PREFIX', '!'), intents=intents)
+# Bot configuration
+memory_profile = os.getenv('MEMORY_PROFILE', 'default').lower()
+bot_options = {'command_prefix': os.getenv('BOT_PREFIX', '!'), **build_client_options(memory_profile)}
+
+# Sharding: SHARD_IDS/SHARD_COUNT are set per process by cluster.py, SHARDING=auto shards in-process
+if os.getenv('SHARD_IDS'):
+    bot = commands.AutoShardedBot(
+        shard_ids=[int(shard_id) for shard_id in os.getenv('SHARD_IDS').split(',')],
+        shard_count=int(os.getenv('SHARD_COUNT')),
+        **bot_options
+    )
+elif os.getenv('SHARDING', 'off').lower() == 'auto':
+    bot = commands.AutoShardedBot(**bot_options)
+else:
+    bot = commands.Bot(**bot_options)
 
 class ModMailDatabase:
     def __init__(self, db_path):
@@ -29,17 +81,43 @@ class ModMailDatabase:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
+        # WAL lets several bot processes (see cluster.py) share the database
+        cursor.execute('PRAGMA journal_mode=WAL')
+
         # Create tickets table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS tickets (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
                 channel_id INTEGER NOT NULL,
+                guild_id INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 is_active BOOLEAN DEFAULT 1
             )
         ''')
 
+        # Add guild_id to databases created before multi-guild support
+        cursor.execute('PRAGMA table_info(tickets)')
+        if 'guild_id' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE tickets ADD COLUMN guild_id INTEGER')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_tickets_user_active
+            ON tickets (user_id, is_active)
+        ''')
+
+        # Create guild_configs table for per-guild settings
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS guild_configs (
+                guild_id INTEGER PRIMARY KEY,
+                support_category_id INTEGER,
+                staff_role_id INTEGER,
+                greeting TEXT,
+                max_open_tickets INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
         # Create ticket_users table for multiple users per ticket
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS ticket_users (
@@ -66,18 +144,103 @@ class ModMailDatabase:
             )
         ''')
 
+        # Create message_relays table mapping each source message to its relayed copies
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_relays (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ticket_id INTEGER NOT NULL,
+                message_row_id INTEGER NOT NULL,
+                source_message_id INTEGER NOT NULL,
+                relay_channel_id INTEGER NOT NULL,
+                relay_message_id INTEGER NOT NULL,
+                FOREIGN KEY (ticket_id) REFERENCES tickets (id),
+                FOREIGN KEY (message_row_id) REFERENCES messages (id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_relays_source
+            ON message_relays (source_message_id)
+        ''')
+
+        # Create message_revisions table for edits and deletions of relayed messages
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_revisions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_row_id INTEGER NOT NULL,
+                revision_type TEXT NOT NULL,
+                content TEXT,
+                revised_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (message_row_id) REFERENCES messages (id)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_revisions_message
+            ON message_revisions (message_row_id)
+        ''')
+
+        # Create attachments table for the content-addressed attachment archive
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attachments (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                content_type TEXT,
+                is_stored BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Create message_attachments table linking message rows to archived files
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_attachments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_row_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                FOREIGN KEY (message_row_id) REFERENCES messages (id),
+                FOREIGN KEY (sha256) REFERENCES attachments (sha256)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_attachments_message
+            ON message_attachments (message_row_id)
+        ''')
+
+        # Create cluster_state table for values shared between bot processes
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cluster_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Create shard_stats table for per-shard throughput and latency
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shard_stats (
+                shard_id INTEGER PRIMARY KEY,
+                process_id INTEGER NOT NULL,
+                events INTEGER NOT NULL DEFAULT 0,
+                events_per_second REAL NOT NULL DEFAULT 0,
+                latency_ms REAL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
         conn.commit()
         conn.close()
 
-    def create_ticket(self, user_id, channel_id):
+    def create_ticket(self, user_id, channel_id, guild_id=None):
         """Create a new support ticket"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
         cursor.execute('''
-            INSERT INTO tickets (user_id, channel_id)
-            VALUES (?, ?)
-        ''', (user_id, channel_id))
+            INSERT INTO tickets (user_id, channel_id, guild_id)
+            VALUES (?, ?, ?)
+        ''', (user_id, channel_id, guild_id))
 
         ticket_id = cursor.lastrowid
         conn.commit()
@@ -85,33 +248,65 @@ class ModMailDatabase:
 
         return ticket_id
 
-    def get_active_ticket(self, user_id):
-        """Get the active ticket for a user"""
+    def get_active_ticket(self, user_id, guild_id):
+        """Get the active ticket for a user in a guild"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
         cursor.execute('''
             SELECT id, channel_id FROM tickets
-            WHERE user_id = ? AND is_active = 1
+            WHERE user_id = ? AND guild_id = ? AND is_active = 1
             ORDER BY created_at DESC
             LIMIT 1
-        ''', (user_id,))
+        ''', (user_id, guild_id))
 
         result = cursor.fetchone()
         conn.close()
 
         return result
 
-    def close_ticket(self, user_id):
-        """Close the active ticket for a user"""
+    def get_active_tickets_for_user(self, user_id):
+        """Get the active tickets for a user in every guild, keyed by guild ID"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
 
         cursor.execute('''
-            UPDATE tickets SET is_active = 0
+            SELECT guild_id, id, channel_id FROM tickets
             WHERE user_id = ? AND is_active = 1
+            ORDER BY created_at ASC
         ''', (user_id,))
 
+        # Newest ticket wins if a guild somehow has more than one
+        tickets = {guild_id: (ticket_id, channel_id) for guild_id, ticket_id, channel_id in cursor.fetchall()}
+        conn.close()
+
+        return tickets
+
+    def count_active_tickets(self, guild_id):
+        """Count the active tickets in a guild"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT COUNT(*) FROM tickets
+            WHERE guild_id = ? AND is_active = 1
+        ''', (guild_id,))
+
+        count = cursor.fetchone()[0]
+        conn.close()
+
+        return count
+
+    def close_ticket(self, user_id, guild_id):
+        """Close the active ticket for a user in a guild"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE tickets SET is_active = 0
+            WHERE user_id = ? AND guild_id = ? AND is_active = 1
+        ''', (user_id, guild_id))
+
         conn.commit()
         conn.close()
 
@@ -151,9 +346,239 @@ class ModMailDatabase:
             VALUES (?, ?, ?, ?, ?)
         ''', (ticket_id, message_id, user_id, content, is_from_user))
 
+        message_row_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+
+        return message_row_id
+
+    def add_message_relays(self, ticket_id, message_row_id, source_message_id, relays):
+        """Record where copies of a source message were sent, as (channel_id, message_id) pairs"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.executemany('''
+            INSERT INTO message_relays (ticket_id, message_row_id, source_message_id, relay_channel_id, relay_message_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(ticket_id, message_row_id, source_message_id, channel_id, message_id) for channel_id, message_id in relays])
+
+        conn.commit()
+        conn.close()
+
+    def get_message_relays(self, source_message_id):
+        """Get the message row and relayed copies of a source message"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT message_relays.message_row_id, messages.is_from_user,
+                   message_relays.relay_channel_id, message_relays.relay_message_id
+            FROM message_relays
+            JOIN messages ON messages.id = message_relays.message_row_id
+            WHERE message_relays.source_message_id = ?
+        ''', (source_message_id,))
+
+        rows = cursor.fetchall()
+        conn.close()
+
+        if not rows:
+            return None
+
+        message_row_id, is_from_user = rows[0][0], bool(rows[0][1])
+        return message_row_id, is_from_user, [(channel_id, message_id) for _, _, channel_id, message_id in rows]
+
+    def add_message_revision(self, message_row_id, revision_type, content=None):
+        """Record an edit or deletion of a message"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT INTO message_revisions (message_row_id, revision_type, content)
+            VALUES (?, ?, ?)
+        ''', (message_row_id, revision_type, content))
+
+        conn.commit()
+        conn.close()
+
+    def get_latest_message_content(self, message_row_id):
+        """Get the content of a message after its most recent edit"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT content FROM message_revisions
+            WHERE message_row_id = ? AND revision_type = 'edit'
+            ORDER BY id DESC
+            LIMIT 1
+        ''', (message_row_id,))
+
+        result = cursor.fetchone()
+        if result is None:
+            cursor.execute('SELECT content FROM messages WHERE id = ?', (message_row_id,))
+            result = cursor.fetchone()
+        conn.close()
+
+        return result[0] if result else None
+
+    def _attachment_usage(self, cursor):
+        """Tracked bytes of stored attachments, computed once if not tracked yet"""
+        cursor.execute("SELECT value FROM cluster_state WHERE key = 'attachment_usage'")
+        result = cursor.fetchone()
+        if result:
+            return result[0]
+
+        cursor.execute('SELECT COALESCE(SUM(size), 0) FROM attachments WHERE is_stored = 1')
+        usage = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO cluster_state (key, value) VALUES ('attachment_usage', ?)", (usage,))
+        return usage
+
+    def store_attachment(self, sha256, size, content_type, place_file):
+        """Put an archived file in place with `place_file` and record it in one write transaction
+
+        Holding the write lock while the file is placed keeps an eviction in any process
+        from deleting it in between. Returns the bytes stored afterwards.
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            usage = self._attachment_usage(cursor)
+            cursor.execute('SELECT is_stored FROM attachments WHERE sha256 = ?', (sha256,))
+            existing = cursor.fetchone()
+
+            place_file()
+
+            cursor.execute('''
+                INSERT INTO attachments (sha256, size, content_type)
+                VALUES (?, ?, ?)
+                ON CONFLICT (sha256) DO UPDATE SET is_stored = 1, last_used_at = CURRENT_TIMESTAMP
+            ''', (sha256, size, content_type))
+
+            if not existing or not existing[0]:
+                usage += size
+                cursor.execute("UPDATE cluster_state SET value = ? WHERE key = 'attachment_usage'", (usage,))
+
+            cursor.execute('COMMIT')
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.close()
+
+        return usage
+
+    def evict_attachments(self, quota_bytes, remove_file):
+        """Evict least recently used attachments with `remove_file` until usage fits the quota
+
+        Runs as one write transaction, so processes sharing the archive see the same usage.
+        Returns the evicted hashes and the bytes still stored.
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        cursor = conn.cursor()
+        evicted = []
+
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            usage = self._attachment_usage(cursor)
+
+            if usage > quota_bytes:
+                cursor.execute('''
+                    SELECT sha256, size FROM attachments
+                    WHERE is_stored = 1
+                    ORDER BY last_used_at ASC
+                ''')
+                for sha256, size in cursor.fetchall():
+                    if usage <= quota_bytes:
+                        break
+                    remove_file(sha256)
+                    evicted.append(sha256)
+                    usage -= size
+
+                cursor.executemany('''
+                    UPDATE attachments SET is_stored = 0
+                    WHERE sha256 = ?
+                ''', [(sha256,) for sha256 in evicted])
+                cursor.execute("UPDATE cluster_state SET value = ? WHERE key = 'attachment_usage'", (usage,))
+
+            cursor.execute('COMMIT')
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.close()
+
+        return evicted, usage
+
+    def get_attachment_usage(self):
+        """Get the tracked total size of stored attachments in bytes"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        usage = self._attachment_usage(cursor)
+
         conn.commit()
         conn.close()
 
+        return usage
+
+    def link_message_attachments(self, message_row_id, attachments):
+        """Reference archived attachments from a message row"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.executemany('''
+            INSERT INTO message_attachments (message_row_id, sha256, filename)
+            VALUES (?, ?, ?)
+        ''', [(message_row_id, sha256, filename) for sha256, filename in attachments])
+
+        conn.commit()
+        conn.close()
+
+    def get_message_attachments(self, message_row_id):
+        """Get the archived attachments of a message row"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT message_attachments.sha256, message_attachments.filename, attachments.is_stored
+            FROM message_attachments
+            JOIN attachments ON attachments.sha256 = message_attachments.sha256
+            WHERE message_attachments.message_row_id = ?
+            ORDER BY message_attachments.id
+        ''', (message_row_id,))
+
+        result = cursor.fetchall()
+        conn.close()
+
+        return result
+
+    def get_stored_attachment_usage(self):
+        """Add up the size of every stored attachment in bytes"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT COALESCE(SUM(size), 0) FROM attachments WHERE is_stored = 1')
+
+        result = cursor.fetchone()[0]
+        conn.close()
+
+        return result
+
+    def get_stored_attachments(self):
+        """Get stored attachments, least recently used first"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT sha256, size FROM attachments
+            WHERE is_stored = 1
+            ORDER BY last_used_at ASC
+        ''')
+
+        result = cursor.fetchall()
+        conn.close()
+
+        return result
+
     def add_user_to_ticket(self, ticket_id, user_id):
         """Add a user to a ticket"""
         conn = sqlite3.connect(self.db_path)
@@ -200,6 +625,149 @@ class ModMailDatabase:
 
         return users
 
+    def assign_legacy_tickets(self, guild_id):
+        """Attach tickets created before multi-guild support to a guild"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            UPDATE tickets SET guild_id = ?
+            WHERE guild_id IS NULL
+        ''', (guild_id,))
+
+        conn.commit()
+        conn.close()
+
+    def get_guild_configs(self):
+        """Get the configuration of every guild"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT guild_id, support_category_id, staff_role_id, greeting, max_open_tickets
+            FROM guild_configs
+        ''')
+
+        configs = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+
+        return configs
+
+    def set_guild_config(self, guild_id, **fields):
+        """Create or update configuration fields for a guild"""
+        columns = ('support_category_id', 'staff_role_id', 'greeting', 'max_open_tickets')
+        unknown = set(fields) - set(columns)
+        if unknown:
+            raise ValueError(f"Unknown guild config fields: {', '.join(sorted(unknown))}")
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT OR IGNORE INTO guild_configs (guild_id) VALUES (?)
+        ''', (guild_id,))
+
+        for column, value in fields.items():
+            cursor.execute(f'''
+                UPDATE guild_configs SET {column} = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE guild_id = ?
+            ''', (value, guild_id))
+
+        conn.commit()
+        conn.close()
+
+        # Tell other bot processes to reload their cached configuration
+        self.bump_config_version()
+
+    def bump_config_version(self):
+        """Bump the counter other bot processes poll to know their config cache is stale"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT INTO cluster_state (key, value) VALUES ('config_version', 1)
+            ON CONFLICT (key) DO UPDATE SET value = value + 1
+        ''')
+
+        conn.commit()
+        conn.close()
+
+    def advance_config_version(self, minimum):
+        """Set the config version past both its current value and `minimum`"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT INTO cluster_state (key, value) VALUES ('config_version', ? + 1)
+            ON CONFLICT (key) DO UPDATE SET value = MAX(value, ?) + 1
+        ''', (minimum, minimum))
+
+        conn.commit()
+        conn.close()
+
+    def get_config_version(self):
+        """Get the counter that is bumped on every guild configuration change"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT value FROM cluster_state WHERE key = 'config_version'
+        ''')
+
+        result = cursor.fetchone()
+        conn.close()
+
+        return result[0] if result else 0
+
+    def save_shard_stats(self, process_id, stats):
+        """Record throughput and latency for the shards owned by this process"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.executemany('''
+            INSERT INTO shard_stats (shard_id, process_id, events, events_per_second, latency_ms, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (shard_id) DO UPDATE SET
+                process_id = excluded.process_id,
+                events = excluded.events,
+                events_per_second = excluded.events_per_second,
+                latency_ms = excluded.latency_ms,
+                updated_at = excluded.updated_at
+        ''', [(shard_id, process_id, *values) for shard_id, values in stats.items()])
+
+        conn.commit()
+        conn.close()
+
+    def delete_stale_shard_stats(self, max_age_seconds):
+        """Remove stats of shards that haven't been updated for `max_age_seconds`"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            DELETE FROM shard_stats
+            WHERE updated_at < datetime('now', ?)
+        ''', (f'-{max_age_seconds} seconds',))
+
+        conn.commit()
+        conn.close()
+
+    def get_shard_stats(self):
+        """Get the latest stats of every shard in the cluster"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT shard_id, process_id, events, events_per_second, latency_ms, updated_at
+            FROM shard_stats
+            ORDER BY shard_id
+        ''')
+
+        stats = cursor.fetchall()
+        conn.close()
+
+        return stats
+
     def get_ticket_by_channel(self, channel_id):
         """Get ticket by channel ID"""
         conn = sqlite3.connect(self.db_path)
@@ -217,8 +785,605 @@ class ModMailDatabase:
 
         return result
 
+class GuildConfigCache:
+    """In-memory map of per-guild configuration, kept in sync with the database"""
+
+    def __init__(self, database):
+        self.db = database
+        self.by_guild = {}
+        self.by_category = {}
+        self.version = None
+
+    def load(self):
+        """(Re)load every guild's configuration from the database"""
+        self.version = self.db.get_config_version()
+        by_guild = {config['guild_id']: config for config in self.db.get_guild_configs()}
+        by_category = {
+            config['support_category_id']: config
+            for config in by_guild.values()
+            if config['support_category_id']
+        }
+
+        # Swap both maps at once so lookups never see a half-built cache
+        self.by_guild, self.by_category = by_guild, by_category
+
+    def get(self, guild_id):
+        """Get the configuration for a guild"""
+        return self.by_guild.get(guild_id)
+
+    def for_category(self, category_id):
+        """Get the configuration of the guild that uses a category for tickets"""
+        return self.by_category.get(category_id)
+
+    def update(self, guild_id, **fields):
+        """Persist configuration changes and refresh the cache"""
+        self.db.set_guild_config(guild_id, **fields)
+        self.load()
+
+    def refresh_if_changed(self):
+        """Reload if another process changed the configuration since our last load"""
+        if self.db.get_config_version() != self.version:
+            self.load()
+            return True
+        return False
+
 # Initialize database
 db = ModMailDatabase(os.getenv('DATABASE_PATH', './data/modmail.db'))
+guild_configs = GuildConfigCache(db)
+guild_configs.load()
+
+def attribute_frame(frame):
+    """Name the bot handler or command coroutine that owns a stack frame"""
+    innermost = frame.f_code.co_name if frame else "unknown"
+
+    # Walk outwards until we hit one of our own coroutines (event handler or command)
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == __file__ and code.co_flags & inspect.CO_COROUTINE:
+            return code.co_name
+        frame = frame.f_back
+
+    return innermost
+
+class LoopWatchdog:
+    """Measure event loop lag and capture the stack of callbacks that block it"""
+
+    def __init__(self, threshold_ms, interval_ms=100):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.loop_thread_id = None
+        self.last_tick = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.offenders = {}
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        """Start the lag probe on the running loop and the sampling thread"""
+        if self._task:
+            return
+
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the lag probe and the sampling thread"""
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _tick(self):
+        """Sleep for a fixed interval and record how late the loop woke us up"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+
+            with self._lock:
+                previous_tick = self.last_tick
+                self.last_tick = now
+                pending = self._pending
+                self._pending = None
+
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+            if lag >= self.threshold:
+                # Only trust a sample taken during this stall, not a stale one
+                if pending and pending[0] == previous_tick:
+                    self._record(lag, pending[1], pending[2])
+                else:
+                    self._record(lag, "unknown", "")
+
+    def _watch(self):
+        """Sample the loop thread's stack while it is stalled past the threshold"""
+        poll = min(self.interval, self.threshold / 4)
+
+        while not self._stop.wait(poll):
+            with self._lock:
+                tick = self.last_tick
+                already_sampled = self._pending is not None and self._pending[0] == tick
+
+            if already_sampled or time.monotonic() - tick - self.interval < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+
+            where = attribute_frame(frame)
+            stack = "".join(traceback.format_stack(frame))
+            del frame
+
+            with self._lock:
+                if self.last_tick == tick:
+                    self._pending = (tick, where, stack)
+
+    def _record(self, lag, where, stack):
+        """Add a stall to the offender table and report it"""
+        self.stalls += 1
+
+        entry = self.offenders.setdefault(where, {"count": 0, "total": 0.0, "max": 0.0, "stack": ""})
+        entry["count"] += 1
+        entry["total"] += lag
+        if lag >= entry["max"]:
+            entry["max"] = lag
+            entry["stack"] = stack or entry["stack"]
+
+        watchdog_log.warning(
+            f"Event loop blocked for {lag * 1000:.0f}ms in {where}",
+            extra={"event": "loop_stall", "handler": where, "lag_ms": round(lag * 1000), "stack": stack}
+        )
+
+    def worst_offenders(self, limit=5):
+        """Return the handlers that blocked the loop the longest in total"""
+        return sorted(self.offenders.items(), key=lambda item: item[1]["total"], reverse=True)[:limit]
+
+watchdog_log = logging.getLogger('modmail.watchdog')
+
+# Optional event loop watchdog (disabled unless a threshold is configured)
+watchdog_threshold_ms = int(os.getenv('LOOP_WATCHDOG_THRESHOLD_MS', '0'))
+watchdog = LoopWatchdog(watchdog_threshold_ms) if watchdog_threshold_ms > 0 else None
+
+class SamplingProfiler:
+    """Sample a thread's stack at a fixed interval and count folded stacks"""
+
+    def __init__(self, thread_id, interval_ms=5):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling on a background thread"""
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampling thread to exit"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            if names:
+                self.samples[";".join(reversed(names))] += 1
+
+    def write(self, path):
+        """Write samples in folded format (flamegraph.pl, speedscope, inferno)"""
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+# Profiling output and per-command timings
+profile_dir = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(db.db_path), 'profiles'))
+profile_lock = asyncio.Lock()
+command_timings = {}
+
+def gateway_sequences():
+    """Last gateway sequence number of each of this process's shards (None until connected)"""
+    if isinstance(bot, commands.AutoShardedBot):
+        # ShardInfo doesn't expose the sequence, so read it from the shard's websocket
+        return {shard_id: shard._parent.ws.sequence for shard_id, shard in bot.shards.items()}
+    return {bot.shard_id or 0: bot.ws.sequence if bot.ws else None}
+
+class ShardStats:
+    """Count gateway events per shard and periodically publish them to the shared store"""
+
+    def __init__(self, database, stale_after=None):
+        self.db = database
+        self.stale_after = stale_after
+        self.events = Counter()
+        self._sequences = {}
+        self._flushed_events = Counter()
+        self._flushed_at = time.monotonic()
+
+    def record(self, shard_id, count=1):
+        self.events[shard_id] += count
+
+    def sample(self):
+        """Count every gateway dispatch since the last sample, from each shard's sequence number"""
+        for shard_id, sequence in gateway_sequences().items():
+            if sequence is None:
+                continue
+
+            # A new session (not a resume) restarts the sequence from 1
+            last = self._sequences.get(shard_id)
+            self.record(shard_id, sequence - last if last is not None and sequence >= last else sequence)
+            self._sequences[shard_id] = sequence
+
+    def flush(self):
+        """Publish event totals, event rates and latency for this process's shards"""
+        self.sample()
+        now = time.monotonic()
+        elapsed = max(now - self._flushed_at, 1e-9)
+
+        if isinstance(bot, commands.AutoShardedBot):
+            latencies = dict(bot.latencies)
+        else:
+            latencies = {bot.shard_id or 0: bot.latency}
+
+        # Report shards that are assigned to us or saw events even if they aren't connected yet
+        for shard_id in [*(getattr(bot, 'shard_ids', None) or []), *self.events]:
+            latencies.setdefault(shard_id, float('nan'))
+
+        stats = {}
+        for shard_id, latency in latencies.items():
+            rate = (self.events[shard_id] - self._flushed_events[shard_id]) / elapsed
+            latency_ms = latency * 1000 if latency == latency and latency != float('inf') else None
+            stats[shard_id] = (self.events[shard_id], rate, latency_ms)
+
+        self.db.save_shard_stats(os.getpid(), stats)
+        # Rows no process has updated for a while belong to shards of an old cluster layout
+        if self.stale_after:
+            self.db.delete_stale_shard_stats(self.stale_after)
+        self._flushed_events = self.events.copy()
+        self._flushed_at = now
+
+        return stats
+
+background_tasks = set()
+cluster_sync_interval = float(os.getenv('CLUSTER_SYNC_INTERVAL', '10'))
+shard_stats = ShardStats(db, stale_after=3 * cluster_sync_interval)
+
+async def cluster_sync():
+    """Keep this process in step with the rest of the cluster through the shared store"""
+    while True:
+        await asyncio.sleep(cluster_sync_interval)
+        try:
+            if guild_configs.refresh_if_changed():
+                log.info("Reloaded guild configuration changed by another process", extra={"event": "config_reloaded"})
+
+            for shard_id, (events, rate, latency_ms) in shard_stats.flush().items():
+                log.debug(
+                    f"Shard {shard_id}: {rate:.2f} events/s, latency {latency_ms}ms",
+                    extra={"event": "shard_stats", "shard_id": shard_id, "events": events, "events_per_second": rate, "latency_ms": latency_ms}
+                )
+        except Exception:
+            log.exception("Cluster sync failed", extra={"event": "cluster_sync_failed"})
+
+# Guilds owned by another process's shards, fetched over the API
+remote_guilds = {}
+
+async def resolve_guild(guild_id):
+    """Get a guild from the cache, or from the API if another process owns its shard"""
+    guild = bot.get_guild(guild_id) or remote_guilds.get(guild_id)
+    if guild is None:
+        try:
+            guild = remote_guilds[guild_id] = await bot.fetch_guild(guild_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+    return guild
+
+async def resolve_channel(channel_id):
+    """Get a channel from the cache, or from the API if another process owns its shard"""
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+    return channel
+
+async def create_ticket_channel(guild_config, user):
+    """Create a ticket channel in a guild's support category"""
+    category = await resolve_channel(guild_config['support_category_id'] or 0)
+    if not category or not isinstance(category, discord.CategoryChannel):
+        return None
+
+    # A fetched category only knows its guild's ID, so create through a full guild object
+    guild = category.guild if isinstance(category.guild, discord.Guild) else await resolve_guild(guild_config['guild_id'])
+    if guild is None:
+        return None
+
+    return await guild.create_text_channel(
+        name=f"ticket-{user.id}",
+        topic=f"Support ticket for {user.mention} ({user.id})",
+        category=category
+    )
+
+class AttachmentStore:
+    """Content-addressed archive of ticket attachments on the data volume"""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, database, root, quota_bytes, max_file_bytes):
+        self.db = database
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.max_file_bytes = max_file_bytes
+        self.session = None
+
+    def path_for(self, sha256):
+        """Path of an archived file, sharded by the first byte of its hash"""
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def get_session(self):
+        """Shared HTTP session for downloads, created on first use"""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+    @property
+    def usage(self):
+        """Bytes currently stored, as tracked in the shared database"""
+        return self.db.get_attachment_usage()
+
+    async def archive(self, attachment):
+        """Stream an attachment to disk in chunks and return its SHA-256, or None if it is too large"""
+        if attachment.size > self.max_file_bytes:
+            return None
+
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".incoming-")
+        digest = hashlib.sha256()
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with self.get_session().get(attachment.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                        digest.update(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+
+            sha256 = digest.hexdigest()
+            await asyncio.to_thread(self._store, temp_path, sha256, attachment.size, attachment.content_type)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return sha256
+
+    def _store(self, temp_path, sha256, size, content_type):
+        """Move a download into place and record it, without racing an eviction in any process"""
+        path = self.path_for(sha256)
+
+        def place_file():
+            # Identical content is already on disk, so keep a single copy
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+
+        self.db.store_attachment(sha256, size, content_type, place_file)
+
+    def _remove(self, sha256):
+        try:
+            os.remove(self.path_for(sha256))
+        except FileNotFoundError:
+            pass
+
+    def enforce_quota(self):
+        """Delete least recently used files until the archive fits its quota"""
+        evicted, usage = self.db.evict_attachments(self.quota_bytes, self._remove)
+
+        if evicted:
+            log.info(
+                f"Evicted {len(evicted)} attachments to stay within quota",
+                extra={"event": "attachments_evicted", "count": len(evicted), "usage_bytes": usage}
+            )
+
+# Attachment archive (ATTACHMENT_ARCHIVE=off keeps relaying straight from Discord's CDN)
+attachment_store = None
+if os.getenv('ATTACHMENT_ARCHIVE', 'on').lower() != 'off':
+    attachment_store = AttachmentStore(
+        db,
+        os.getenv('ATTACHMENT_DIR', os.path.join(os.path.dirname(db.db_path), 'attachments')),
+        quota_bytes=int(float(os.getenv('ATTACHMENT_QUOTA_MB', '1024')) * 1024 * 1024),
+        max_file_bytes=int(float(os.getenv('ATTACHMENT_MAX_MB', '25')) * 1024 * 1024)
+    )
+
+async def archive_attachments(message):
+    """Archive a message's attachments, returning (attachment, sha256 or None) pairs"""
+    if not message.attachments or not attachment_store:
+        return [(attachment, None) for attachment in message.attachments]
+
+    archived = []
+    for attachment in message.attachments:
+        try:
+            sha256 = await attachment_store.archive(attachment)
+        except Exception:
+            log.exception(
+                f"Could not archive attachment {attachment.filename}",
+                extra={"event": "attachment_archive_failed", "user_id": message.author.id}
+            )
+            sha256 = None
+        archived.append((attachment, sha256))
+
+    await asyncio.to_thread(attachment_store.enforce_quota)
+    return archived
+
+async def build_files(archived):
+    """Build files to relay, reading archived copies from disk and downloading the rest"""
+    files = []
+    for attachment, sha256 in archived:
+        path = attachment_store.path_for(sha256) if sha256 else None
+        if path and os.path.exists(path):
+            files.append(discord.File(path, filename=attachment.filename, spoiler=attachment.is_spoiler()))
+        else:
+            files.append(await attachment.to_file())
+    return files
+
+def link_archived_attachments(message_row_id, archived):
+    """Reference a message's archived attachments from its database row"""
+    stored = [(sha256, attachment.filename) for attachment, sha256 in archived if sha256]
+    if stored:
+        db.link_message_attachments(message_row_id, stored)
+
+class BackupManager:
+    """Online SQLite backups taken page by page on a background thread"""
+
+    def __init__(self, database, backup_dir, keep, compress, pages_per_step=256, step_sleep=0.005):
+        self.db = database
+        self.db_path = database.db_path
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.compress = compress
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.last_duration = None
+        self.last_size = None
+        self.last_backup_at = None
+        self._lock = asyncio.Lock()
+
+    def list_backups(self):
+        """Backup file names, newest first"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+
+        names = [
+            name for name in os.listdir(self.backup_dir)
+            if name.startswith("modmail-") and name.endswith((".db", ".db.gz"))
+        ]
+        return sorted(names, reverse=True)
+
+    def _backup(self, label):
+        os.makedirs(self.backup_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.backup_dir, f"modmail-{stamp}{label}.db")
+        partial_path = path + ".partial"
+
+        # Copy a few pages per step and sleep in between so writers are only briefly locked out
+        source = sqlite3.connect(self.db_path)
+        target = sqlite3.connect(partial_path)
+        try:
+            source.backup(target, pages=self.pages_per_step, sleep=self.step_sleep)
+        finally:
+            target.close()
+            source.close()
+
+        if self.compress:
+            with open(partial_path, "rb") as raw, gzip.open(partial_path + ".gz", "wb") as compressed:
+                shutil.copyfileobj(raw, compressed)
+            os.remove(partial_path)
+            path += ".gz"
+            partial_path += ".gz"
+
+        os.replace(partial_path, path)
+        return path
+
+    def _rotate(self):
+        for name in self.list_backups()[self.keep:]:
+            os.remove(os.path.join(self.backup_dir, name))
+
+    def _restore(self, name):
+        path = os.path.join(self.backup_dir, name)
+
+        if name.endswith(".gz"):
+            fd, restore_path = tempfile.mkstemp(dir=self.backup_dir, suffix=".db")
+            with os.fdopen(fd, "wb") as raw, gzip.open(path, "rb") as compressed:
+                shutil.copyfileobj(compressed, raw)
+        else:
+            restore_path = path
+
+        # Copy the backup into the live database so open connections see it immediately
+        source = sqlite3.connect(restore_path)
+        target = sqlite3.connect(self.db_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+            if restore_path != path:
+                os.remove(restore_path)
+
+    async def backup(self, label="", rotate=True):
+        """Take a backup without blocking the event loop and rotate old ones"""
+        async with self._lock:
+            started = time.perf_counter()
+            path = await asyncio.to_thread(self._backup, label)
+            self.last_duration = time.perf_counter() - started
+            self.last_size = os.path.getsize(path)
+            self.last_backup_at = datetime.now(timezone.utc)
+            if rotate:
+                await asyncio.to_thread(self._rotate)
+
+        log.info(
+            f"Backed up database to {path} in {self.last_duration * 1000:.0f}ms",
+            extra={"event": "backup_completed", "path": path, "duration_ms": round(self.last_duration * 1000), "size_bytes": self.last_size}
+        )
+        return path
+
+    async def restore(self, name):
+        """Replace the live database with a backup, keeping a backup of the current state first"""
+        if name not in self.list_backups():
+            raise FileNotFoundError(name)
+
+        # Rotate only afterwards so the backup being restored can't be removed first
+        await self.backup("-pre-restore", rotate=False)
+        async with self._lock:
+            config_version = await asyncio.to_thread(self.db.get_config_version)
+            await asyncio.to_thread(self._restore, name)
+
+            # Older backups may predate tables added since, and carry an older config version.
+            # Other processes reload when the version differs from theirs, so move past any they may hold.
+            await asyncio.to_thread(self.db.init_database)
+            await asyncio.to_thread(self.db.advance_config_version, config_version)
+            await asyncio.to_thread(self._rotate)
+
+        log.warning(f"Restored database from {name}", extra={"event": "backup_restored", "path": name})
+
+backup_manager = BackupManager(
+    db,
+    os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(db.db_path), 'backups')),
+    keep=int(os.getenv('BACKUP_KEEP', '7')),
+    compress=os.getenv('BACKUP_COMPRESS', 'off').lower() == 'on'
+)
+backup_interval_hours = float(os.getenv('BACKUP_INTERVAL_HOURS', '0'))
+
+async def scheduled_backups():
+    """Back up the database every BACKUP_INTERVAL_HOURS"""
+    while True:
+        await asyncio.sleep(backup_interval_hours * 3600)
+        try:
+            await backup_manager.backup()
+        except Exception:
+            log.exception("Scheduled backup failed", extra={"event": "backup_failed"})
 
 def process_attachments(message):
     """Process message attachments and return formatted content"""
@@ -256,15 +1421,47 @@ def create_embed_with_attachments(title, description, color, message, files=None
 
     return embed
 
+@bot.event
+async def setup_hook():
+    # Start the loop watchdog as soon as the event loop is running
+    if watchdog:
+        watchdog.start()
+        watchdog_log.info(f"Event loop watchdog enabled (threshold {watchdog_threshold_ms}ms)")
+
+    # Keep a reference so the task isn't garbage collected
+    background_tasks.add(asyncio.create_task(cluster_sync()))
+
+    # Only one process in a cluster takes scheduled backups
+    if backup_interval_hours > 0 and os.getenv('CLUSTER_ID', '0') == '0':
+        background_tasks.add(asyncio.create_task(scheduled_backups()))
+
 @bot.event
 async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
-    print(f'Bot is in {len(bot.guilds)} guilds')
+    log.info(f'{bot.user} has connected to Discord!', extra={"event": "ready"})
+    log.info(f'Bot is in {len(bot.guilds)} guilds', extra={"event": "guild_count", "guilds": len(bot.guilds)})
+
+    # Seed the guild of the legacy SUPPORT_TICKET_PARENT category if it isn't configured yet
+    legacy_category_id = os.getenv('SUPPORT_TICKET_PARENT', '').strip()
+    if legacy_category_id and not legacy_category_id.isdigit():
+        log.warning(
+            f"Ignoring SUPPORT_TICKET_PARENT, which is not a channel ID: {legacy_category_id}",
+            extra={"event": "legacy_config_invalid"}
+        )
+    elif legacy_category_id:
+        legacy_category = bot.get_channel(int(legacy_category_id))
+        if isinstance(legacy_category, discord.CategoryChannel) and not guild_configs.get(legacy_category.guild.id):
+            guild_configs.update(legacy_category.guild.id, support_category_id=legacy_category.id)
+            db.assign_legacy_tickets(legacy_category.guild.id)
+            log.info(
+                "Imported SUPPORT_TICKET_PARENT as guild configuration",
+                extra={"event": "legacy_config_imported", "guild_id": legacy_category.guild.id}
+            )
 
     # Clean up any invalid tickets (tickets with category IDs instead of channel IDs)
-    support_category_id = int(os.getenv('SUPPORT_TICKET_PARENT'))
-    db.cleanup_invalid_tickets(support_category_id)
-    print("Cleaned up invalid tickets from database")
+    for config in guild_configs.by_guild.values():
+        if config['support_category_id']:
+            db.cleanup_invalid_tickets(config['support_category_id'])
+    log.info("Cleaned up invalid tickets from database", extra={"event": "ticket_cleanup"})
 
 @bot.event
 async def on_message(message):
@@ -275,38 +1472,225 @@ async def on_message(message):
     # Handle DM messages
     if isinstance(message.channel, discord.DMChannel):
         await handle_dm_message(message)
-    # Handle messages in support channels (any channel in the support category)
-    elif (isinstance(message.channel, discord.TextChannel) and
-          message.channel.category and
-          message.channel.category.id == int(os.getenv('SUPPORT_TICKET_PARENT'))):
-        await handle_support_channel_message(message)
+    # Handle messages in support channels (any channel in a configured support category)
+    elif isinstance(message.channel, discord.TextChannel) and message.channel.category_id:
+        guild_config = guild_configs.for_category(message.channel.category_id)
+        if guild_config and guild_config['guild_id'] == message.guild.id:
+            await handle_support_channel_message(message)
 
     # Process commands
     await bot.process_commands(message)
 
+# Guild a user last picked for their DMs while they have tickets in several guilds
+dm_guild_choices = {}
+
+# Cached membership checks, keyed by (guild_id, user_id), so repeat DMs don't hit the API
+membership_cache = {}
+MEMBERSHIP_CACHE_SECONDS = 600
+# Membership checks against the API run at most this many at a time
+membership_checks = asyncio.Semaphore(5)
+
+class GuildPickerView(discord.ui.View):
+    """Let a user who shares several support guilds with the bot choose where a DM goes"""
+
+    # Discord allows at most 25 options in a select menu, so longer lists are paged
+    PAGE_SIZE = 25
+
+    def __init__(self, message, configs):
+        super().__init__(timeout=300)
+        self.message = message
+        self.prompt = None
+        self.page = 0
+
+        self.options = []
+        for config in configs:
+            guild = bot.get_guild(config['guild_id']) or remote_guilds.get(config['guild_id'])
+            label = guild.name if guild else f"Server {config['guild_id']}"
+            self.options.append(discord.SelectOption(label=label[:100], value=str(config['guild_id'])))
+        self.pages = (len(self.options) + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+
+        self.select = discord.ui.Select(placeholder="Choose a server")
+        self.select.callback = self.on_select
+        self.add_item(self.select)
+
+        if self.pages > 1:
+            self.previous_button = discord.ui.Button(label="Previous", style=discord.ButtonStyle.secondary)
+            self.previous_button.callback = self.on_previous
+            self.next_button = discord.ui.Button(label="Next", style=discord.ButtonStyle.secondary)
+            self.next_button.callback = self.on_next
+            self.add_item(self.previous_button)
+            self.add_item(self.next_button)
+
+        self.show_page()
+
+    def show_page(self):
+        """Fill the select menu with the options on the current page"""
+        start = self.page * self.PAGE_SIZE
+        self.select.options = self.options[start:start + self.PAGE_SIZE]
+
+        if self.pages > 1:
+            self.select.placeholder = f"Choose a server (page {self.page + 1} of {self.pages})"
+            self.previous_button.disabled = self.page == 0
+            self.next_button.disabled = self.page == self.pages - 1
+
+    async def on_previous(self, interaction):
+        self.page = max(self.page - 1, 0)
+        self.show_page()
+        await interaction.response.edit_message(view=self)
+
+    async def on_next(self, interaction):
+        self.page = min(self.page + 1, self.pages - 1)
+        self.show_page()
+        await interaction.response.edit_message(view=self)
+
+    async def on_select(self, interaction):
+        guild_id = int(self.select.values[0])
+        guild_config = guild_configs.get(guild_id)
+        if not guild_config:
+            await interaction.response.edit_message(content="That server is no longer available.", view=None)
+            return
+
+        label = next(option.label for option in self.select.options if option.value == self.select.values[0])
+        await interaction.response.edit_message(content=f"Sending your message to **{label}**.", view=None)
+        self.stop()
+
+        dm_guild_choices[self.message.author.id] = guild_id
+        await forward_dm_to_guild(self.message, guild_config)
+
+    async def on_timeout(self):
+        if self.prompt:
+            try:
+                await self.prompt.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+        try:
+            await self.message.author.send(
+                "Your message was not delivered because no server was chosen. Please send it again."
+            )
+        except discord.HTTPException:
+            pass
+
+async def get_user_guild_configs(user):
+    """Get the configured guilds a user is a member of"""
+    configs = [config for config in guild_configs.by_guild.values() if config['support_category_id']]
+
+    # Membership of a lone guild is checked when the ticket is opened
+    if len(configs) <= 1:
+        return configs
+
+    # Guilds the cache already places the user in need no API call; the rest are checked
+    # a few at a time and cached, so only the first DM in a while pays for it
+    mutual = {guild.id for guild in getattr(user, 'mutual_guilds', [])}
+
+    async def check(config):
+        if config['guild_id'] in mutual:
+            return True
+        async with membership_checks:
+            return await is_guild_member(config['guild_id'], user)
+
+    results = await asyncio.gather(*(check(config) for config in configs))
+    return [config for config, is_member in zip(configs, results) if is_member]
+
+async def is_guild_member(guild_id, user):
+    """Check whether a user is in a guild, caching the answer; None if it couldn't be checked"""
+    key = (guild_id, user.id)
+    cached = membership_cache.get(key)
+    if cached and time.monotonic() - cached[1] < MEMBERSHIP_CACHE_SECONDS:
+        return cached[0]
+
+    guild = await resolve_guild(guild_id)
+    if guild is None:
+        return False
+
+    # The member cache may be incomplete, so fall back to the API
+    if guild.get_member(user.id):
+        is_member = True
+    else:
+        try:
+            await guild.fetch_member(user.id)
+            is_member = True
+        except discord.NotFound:
+            is_member = False
+        except discord.HTTPException as e:
+            log.warning(
+                f"Could not check membership of user {user.id}: {e}",
+                extra={"event": "membership_check_failed", "guild_id": guild_id, "user_id": user.id}
+            )
+            return None
+
+    membership_cache[key] = (is_member, time.monotonic())
+    return is_member
+
 async def handle_dm_message(message):
     """Handle direct messages from users"""
     user_id = message.author.id
 
+    # Route to the guild of an existing ticket where possible
+    active = {
+        guild_id: ticket
+        for guild_id, ticket in db.get_active_tickets_for_user(user_id).items()
+        if guild_configs.get(guild_id)
+    }
+
+    if len(active) == 1:
+        await forward_dm_to_guild(message, guild_configs.get(next(iter(active))))
+        return
+
+    if len(active) > 1:
+        if dm_guild_choices.get(user_id) in active:
+            await forward_dm_to_guild(message, guild_configs.get(dm_guild_choices[user_id]))
+            return
+        candidates = [guild_configs.get(guild_id) for guild_id in active]
+    else:
+        candidates = await get_user_guild_configs(message.author)
+
+    if not candidates:
+        await message.author.send("Error: Support is not set up in any server you share with me.")
+        return
+
+    if len(candidates) == 1:
+        await forward_dm_to_guild(message, candidates[0])
+        return
+
+    view = GuildPickerView(message, candidates)
+    prompt = "Which server is this message for?"
+    if view.pages > 1:
+        prompt += f" You share {len(candidates)} servers with me; use Next and Previous to see them all."
+    view.prompt = await message.author.send(prompt, view=view)
+
+async def forward_dm_to_guild(message, guild_config):
+    """Forward a direct message to the user's ticket in a guild, opening one if needed"""
+    user_id = message.author.id
+    guild_id = guild_config['guild_id']
+    greeting = guild_config['greeting'] or "Your support ticket has been created! A staff member will respond soon."
+
     # Check if user has an active ticket
-    ticket = db.get_active_ticket(user_id)
+    ticket = db.get_active_ticket(user_id, guild_id)
 
     if not ticket:
-        # Create new ticket
-        support_category_id = int(os.getenv('SUPPORT_TICKET_PARENT'))
-        support_category = bot.get_channel(support_category_id)
+        # Only members of the guild may open a ticket there
+        is_member = await is_guild_member(guild_id, message.author)
+        if is_member is None:
+            await message.author.send("Error: Could not reach that server right now. Please try again later.")
+            return
+        if not is_member:
+            await message.author.send("Error: You are not a member of that server.")
+            return
 
-        if not support_category or not isinstance(support_category, discord.CategoryChannel):
-            await message.author.send("Error: Support category not found or invalid.")
+        # Respect the guild's limit on open tickets
+        if guild_config['max_open_tickets'] and db.count_active_tickets(guild_id) >= guild_config['max_open_tickets']:
+            await message.author.send("Support is at capacity right now. Please try again later.")
             return
 
         # Create a new text channel for this ticket
-        ticket_channel = await support_category.create_text_channel(
-            name=f"ticket-{message.author.id}",
-            topic=f"Support ticket for {message.author.mention} ({message.author.id})"
-        )
+        ticket_channel = await create_ticket_channel(guild_config, message.author)
+
+        if not ticket_channel:
+            await message.author.send("Error: Support category not found or invalid.")
+            return
 
-        ticket_id = db.create_ticket(user_id, ticket_channel.id)
+        ticket_id = db.create_ticket(user_id, ticket_channel.id, guild_id)
 
         # Add the original user to the ticket
         db.add_user_to_ticket(ticket_id, user_id)
@@ -321,22 +1705,25 @@ async def handle_dm_message(message):
         embed.add_field(name="Message", value=message.content or "*No text content*", inline=False)
         embed.set_footer(text=f"Ticket ID: {ticket_id}")
 
-        # Send message with attachments if any
+        # Send message with attachments if any, from the archived copies
+        archived = await archive_attachments(message)
         if message.attachments:
-            files = [await attachment.to_file() for attachment in message.attachments]
+            files = await build_files(archived)
             sent_message = await ticket_channel.send(embed=embed, files=files)
         else:
             sent_message = await ticket_channel.send(embed=embed)
 
         # Store message in database
-        db.add_message(ticket_id, sent_message.id, user_id, message.content, True)
+        message_row_id = db.add_message(ticket_id, sent_message.id, user_id, message.content, True)
+        link_archived_attachments(message_row_id, archived)
+        db.add_message_relays(ticket_id, message_row_id, message.id, [(sent_message.channel.id, sent_message.id)])
 
         # Send confirmation to user
-        await message.author.send("Your support ticket has been created! A staff member will respond soon.")
+        await message.author.send(greeting)
     else:
         # Forward message to support channel
         ticket_id, support_channel_id = ticket
-        support_channel = bot.get_channel(support_channel_id)
+        support_channel = await resolve_channel(support_channel_id)
 
         # Check if the stored channel is valid and is a text channel
         if support_channel and isinstance(support_channel, discord.TextChannel):
@@ -349,33 +1736,29 @@ async def handle_dm_message(message):
             embed.add_field(name="Message", value=message.content or "*No text content*", inline=False)
             embed.set_footer(text=f"Ticket ID: {ticket_id}")
 
-            # Send message with attachments if any
+            # Send message with attachments if any, from the archived copies
+            archived = await archive_attachments(message)
             if message.attachments:
-                files = [await attachment.to_file() for attachment in message.attachments]
+                files = await build_files(archived)
                 sent_message = await support_channel.send(embed=embed, files=files)
             else:
                 sent_message = await support_channel.send(embed=embed)
 
             # Store message in database
-            db.add_message(ticket_id, sent_message.id, user_id, message.content, True)
+            message_row_id = db.add_message(ticket_id, sent_message.id, user_id, message.content, True)
+            link_archived_attachments(message_row_id, archived)
+            db.add_message_relays(ticket_id, message_row_id, message.id, [(sent_message.channel.id, sent_message.id)])
         else:
             # If the stored channel is invalid (e.g., it's a category), create a new ticket
             await message.author.send("Your previous ticket channel is no longer available. Creating a new ticket...")
 
-            # Create new ticket
-            support_category_id = int(os.getenv('SUPPORT_TICKET_PARENT'))
-            support_category = bot.get_channel(support_category_id)
+            # Create a new text channel for this ticket
+            ticket_channel = await create_ticket_channel(guild_config, message.author)
 
-            if not support_category or not isinstance(support_category, discord.CategoryChannel):
+            if not ticket_channel:
                 await message.author.send("Error: Support category not found or invalid.")
                 return
 
-            # Create a new text channel for this ticket
-            ticket_channel = await support_category.create_text_channel(
-                name=f"ticket-{message.author.id}",
-                topic=f"Support ticket for {message.author.mention} ({message.author.id})"
-            )
-
             # Update the ticket with the new channel ID
             db.update_ticket_channel(ticket_id, ticket_channel.id)
 
@@ -389,15 +1772,18 @@ async def handle_dm_message(message):
             embed.add_field(name="Message", value=message.content or "*No text content*", inline=False)
             embed.set_footer(text=f"Ticket ID: {ticket_id}")
 
-            # Send message with attachments if any
+            # Send message with attachments if any, from the archived copies
+            archived = await archive_attachments(message)
             if message.attachments:
-                files = [await attachment.to_file() for attachment in message.attachments]
+                files = await build_files(archived)
                 sent_message = await ticket_channel.send(embed=embed, files=files)
             else:
                 sent_message = await ticket_channel.send(embed=embed)
 
             # Store message in database
-            db.add_message(ticket_id, sent_message.id, user_id, message.content, True)
+            message_row_id = db.add_message(ticket_id, sent_message.id, user_id, message.content, True)
+            link_archived_attachments(message_row_id, archived)
+            db.add_message_relays(ticket_id, message_row_id, message.id, [(sent_message.channel.id, sent_message.id)])
 
             # Send confirmation to user
             await message.author.send("Your support ticket has been recreated! A staff member will respond soon.")
@@ -431,6 +1817,10 @@ async def handle_support_channel_message(message):
                     # Get all users in this ticket
                     ticket_users = db.get_ticket_users(ticket_id)
 
+                    # Archive attachments once, then relay the local copies to every user
+                    archived = await archive_attachments(message)
+                    relays = []
+
                     # Send message to all users in the ticket
                     for user_id in ticket_users:
                         try:
@@ -446,28 +1836,35 @@ async def handle_support_channel_message(message):
                             try:
                                 # Send message with attachments if any
                                 if message.attachments:
-                                    files = [await attachment.to_file() for attachment in message.attachments]
-                                    await user.send(embed=embed, files=files)
+                                    files = await build_files(archived)
+                                    sent_message = await user.send(embed=embed, files=files)
                                 else:
-                                    await user.send(embed=embed)
+                                    sent_message = await user.send(embed=embed)
+                                relays.append((sent_message.channel.id, sent_message.id))
                             except discord.Forbidden:
-                                print(f"Could not send message to user {user_id}")
+                                log.warning(f"Could not send message to user {user_id}", extra={"event": "relay_forbidden", "ticket_id": ticket_id, "user_id": user_id})
                         except discord.NotFound:
-                            print(f"User {user_id} not found")
-                        except Exception as e:
-                            print(f"Error fetching user {user_id}: {e}")
+                            log.warning(f"User {user_id} not found", extra={"event": "relay_user_not_found", "ticket_id": ticket_id, "user_id": user_id})
+                        except Exception:
+                            log.exception(f"Error fetching user {user_id}", extra={"event": "relay_failed", "ticket_id": ticket_id, "user_id": user_id})
 
                     # Store message in database for the first user (original ticket creator)
                     if ticket_users:
-                        db.add_message(ticket_id, message.id, ticket_users[0], message.content, False)
-        except Exception as e:
-            print(f"Error handling support channel message reply: {e}")
+                        message_row_id = db.add_message(ticket_id, message.id, ticket_users[0], message.content, False)
+                        link_archived_attachments(message_row_id, archived)
+                        db.add_message_relays(ticket_id, message_row_id, message.id, relays)
+        except Exception:
+            log.exception("Error handling support channel message reply", extra={"event": "staff_reply_failed", "ticket_id": ticket_id})
     else:
         # Handle regular messages in ticket channels
         try:
             # Get all users in this ticket
             ticket_users = db.get_ticket_users(ticket_id)
 
+            # Archive attachments once, then relay the local copies to every user
+            archived = await archive_attachments(message)
+            relays = []
+
             # Send message to all users in the ticket
             for user_id in ticket_users:
                 try:
@@ -483,37 +1880,193 @@ async def handle_support_channel_message(message):
                     try:
                         # Send message with attachments if any
                         if message.attachments:
-                            files = [await attachment.to_file() for attachment in message.attachments]
-                            await user.send(embed=embed, files=files)
+                            files = await build_files(archived)
+                            sent_message = await user.send(embed=embed, files=files)
                         else:
-                            await user.send(embed=embed)
+                            sent_message = await user.send(embed=embed)
+                        relays.append((sent_message.channel.id, sent_message.id))
                     except discord.Forbidden:
-                        print(f"Could not send message to user {user_id}")
+                        log.warning(f"Could not send message to user {user_id}", extra={"event": "relay_forbidden", "ticket_id": ticket_id, "user_id": user_id})
                 except discord.NotFound:
-                    print(f"User {user_id} not found")
-                except Exception as e:
-                    print(f"Error fetching user {user_id}: {e}")
+                    log.warning(f"User {user_id} not found", extra={"event": "relay_user_not_found", "ticket_id": ticket_id, "user_id": user_id})
+                except Exception:
+                    log.exception(f"Error fetching user {user_id}", extra={"event": "relay_failed", "ticket_id": ticket_id, "user_id": user_id})
 
             # Store message in database for the first user (original ticket creator)
             if ticket_users:
-                db.add_message(ticket_id, message.id, ticket_users[0], message.content, False)
-        except Exception as e:
-            print(f"Error handling support channel message: {e}")
+                message_row_id = db.add_message(ticket_id, message.id, ticket_users[0], message.content, False)
+                link_archived_attachments(message_row_id, archived)
+                db.add_message_relays(ticket_id, message_row_id, message.id, relays)
+        except Exception:
+            log.exception("Error handling support channel message", extra={"event": "staff_message_failed", "ticket_id": ticket_id})
+
+@bot.event
+async def on_message_edit(before, after):
+    # Ignore edits that don't change the text, such as link previews being added
+    if before.content != after.content:
+        await sync_message_edit(after.id, after.channel.id, after.guild and after.guild.id, after.author.id, after.content)
+
+@bot.event
+async def on_raw_message_edit(payload):
+    # Messages still in discord.py's cache are handled by on_message_edit
+    if payload.cached_message is not None or 'content' not in payload.data:
+        return
+
+    author_id = int(payload.data.get('author', {}).get('id', 0))
+    await sync_message_edit(payload.message_id, payload.channel_id, payload.guild_id, author_id, payload.data['content'])
+
+@bot.event
+async def on_message_delete(message):
+    await sync_message_delete(message.id, message.channel.id, message.guild and message.guild.id)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    # Messages still in discord.py's cache are handled by on_message_delete
+    if payload.cached_message is None:
+        await sync_message_delete(payload.message_id, payload.channel_id, payload.guild_id)
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    # Purges are only handled here, cached or not, so each message is synced exactly once
+    for message_id in payload.message_ids:
+        await sync_message_delete(message_id, payload.channel_id, payload.guild_id)
+
+def may_have_relays(channel_id, guild_id):
+    """Whether a channel can hold relayed source messages (DMs and ticket channels)"""
+    if guild_id is None:
+        return True
+
+    # Uncached channels (e.g. owned by another shard) are checked against the database
+    channel = bot.get_channel(channel_id)
+    return channel is None or guild_configs.for_category(getattr(channel, 'category_id', None)) is not None
+
+async def sync_message_edit(message_id, channel_id, guild_id, author_id, content):
+    """Apply an edit of a relayed message to all of its copies"""
+    # Our own relayed copies are never sources
+    if author_id == bot.user.id or not may_have_relays(channel_id, guild_id):
+        return
+
+    relay = db.get_message_relays(message_id)
+    if not relay:
+        return
+
+    message_row_id, is_from_user, relays = relay
+    if content == db.get_latest_message_content(message_row_id):
+        return
+
+    db.add_message_revision(message_row_id, 'edit', content)
+    text = content or "*No text content*"
+
+    for channel_id, relay_message_id in relays:
+        try:
+            relayed = await bot.get_partial_messageable(channel_id).fetch_message(relay_message_id)
+            if not relayed.embeds:
+                continue
+
+            embed = relayed.embeds[0]
+            if is_from_user:
+                # User messages are shown in the "Message" field of the ticket channel embed
+                for index, field in enumerate(embed.fields):
+                    if field.name.startswith("Message"):
+                        embed.set_field_at(index, name="Message (edited)", value=text[:1024], inline=False)
+                        break
+            else:
+                # Staff messages are the description of the DM embed
+                embed.description = text
+                embed.title = "Staff Response (edited)"
+
+            await relayed.edit(embed=embed)
+        except discord.NotFound:
+            continue
+        except discord.HTTPException as e:
+            log.warning(
+                f"Could not edit relayed message {relay_message_id}: {e}",
+                extra={"event": "relay_edit_failed", "message_id": message_id}
+            )
+
+async def sync_message_delete(message_id, channel_id, guild_id):
+    """Apply a deletion of a relayed message to all of its copies"""
+    if not may_have_relays(channel_id, guild_id):
+        return
+
+    relay = db.get_message_relays(message_id)
+    if not relay:
+        return
+
+    message_row_id, is_from_user, relays = relay
+    db.add_message_revision(message_row_id, 'delete')
+
+    for channel_id, relay_message_id in relays:
+        try:
+            partial = bot.get_partial_messageable(channel_id).get_partial_message(relay_message_id)
+            if is_from_user:
+                # Keep the ticket channel copy for staff, but mark it as deleted
+                relayed = await partial.fetch()
+                if not relayed.embeds:
+                    continue
+                embed = relayed.embeds[0]
+                embed.title = f"{embed.title} (deleted by user)"
+                embed.color = 0x808080
+                await relayed.edit(embed=embed)
+            else:
+                # Staff retracted the message, so remove it from users' DMs
+                await partial.delete()
+        except discord.NotFound:
+            continue
+        except discord.HTTPException as e:
+            log.warning(
+                f"Could not update relayed message {relay_message_id} after deletion: {e}",
+                extra={"event": "relay_delete_failed", "message_id": message_id}
+            )
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_started_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_timing(ctx):
+    """Accumulate wall-clock time spent in each command handler"""
+    started_at = getattr(ctx, 'command_started_at', None)
+    if started_at is None:
+        return
+
+    elapsed = time.perf_counter() - started_at
+    entry = command_timings.setdefault(ctx.command.qualified_name, {"count": 0, "total": 0.0, "max": 0.0})
+    entry["count"] += 1
+    entry["total"] += elapsed
+    entry["max"] = max(entry["max"], elapsed)
+
+def is_staff():
+    """Allow members with Manage Messages or the guild's configured staff role"""
+    async def predicate(ctx):
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+
+        if ctx.author.guild_permissions.manage_messages:
+            return True
+
+        guild_config = guild_configs.get(ctx.guild.id)
+        if guild_config and guild_config['staff_role_id'] and ctx.author.get_role(guild_config['staff_role_id']):
+            return True
+
+        raise commands.MissingPermissions(['manage_messages'])
+
+    return commands.check(predicate)
 
 @bot.command(name='close')
-@commands.has_permissions(manage_messages=True)
+@is_staff()
 async def close_ticket(ctx, user_id: int = None):
     """Close a support ticket and notify all users"""
     if user_id:
         # Get the ticket
-        ticket = db.get_active_ticket(user_id)
+        ticket = db.get_active_ticket(user_id, ctx.guild.id)
         if ticket:
             ticket_id, _ = ticket
             # Get all users in the ticket
             ticket_users = db.get_ticket_users(ticket_id)
 
             # Close the ticket
-            db.close_ticket(user_id)
+            db.close_ticket(user_id, ctx.guild.id)
 
             # Notify all users
             for uid in ticket_users:
@@ -527,11 +2080,11 @@ async def close_ticket(ctx, user_id: int = None):
                     )
                     await user.send(embed=embed)
                 except discord.NotFound:
-                    print(f"User {uid} not found for close notification")
+                    log.warning(f"User {uid} not found for close notification", extra={"event": "close_notify_user_not_found", "ticket_id": ticket_id, "user_id": uid})
                 except discord.Forbidden:
-                    print(f"Could not send close notification to user {uid}")
-                except Exception as e:
-                    print(f"Error fetching user {uid} for close notification: {e}")
+                    log.warning(f"Could not send close notification to user {uid}", extra={"event": "close_notify_forbidden", "ticket_id": ticket_id, "user_id": uid})
+                except Exception:
+                    log.exception(f"Error fetching user {uid} for close notification", extra={"event": "close_notify_failed", "ticket_id": ticket_id, "user_id": uid})
 
             await ctx.send(f"Ticket for user {user_id} has been closed and all users have been notified.")
         else:
@@ -545,7 +2098,7 @@ async def close_ticket(ctx, user_id: int = None):
             ticket_users = db.get_ticket_users(ticket_id)
 
             # Close the ticket
-            db.close_ticket(original_user_id)
+            db.close_ticket(original_user_id, ctx.guild.id)
 
             # Notify all users
             for uid in ticket_users:
@@ -559,28 +2112,28 @@ async def close_ticket(ctx, user_id: int = None):
                     )
                     await user.send(embed=embed)
                 except discord.NotFound:
-                    print(f"User {uid} not found for close notification")
+                    log.warning(f"User {uid} not found for close notification", extra={"event": "close_notify_user_not_found", "ticket_id": ticket_id, "user_id": uid})
                 except discord.Forbidden:
-                    print(f"Could not send close notification to user {uid}")
-                except Exception as e:
-                    print(f"Error fetching user {uid} for close notification: {e}")
+                    log.warning(f"Could not send close notification to user {uid}", extra={"event": "close_notify_forbidden", "ticket_id": ticket_id, "user_id": uid})
+                except Exception:
+                    log.exception(f"Error fetching user {uid} for close notification", extra={"event": "close_notify_failed", "ticket_id": ticket_id, "user_id": uid})
 
             await ctx.send("This ticket has been closed and all users have been notified.")
         else:
             await ctx.send("No active ticket found in this channel. Please provide a user ID.")
 
 @bot.command(name='tickets')
-@commands.has_permissions(manage_messages=True)
+@is_staff()
 async def list_tickets(ctx):
-    """List all active tickets"""
+    """List all active tickets in this server"""
     conn = sqlite3.connect(db.db_path)
     cursor = conn.cursor()
 
     cursor.execute('''
         SELECT user_id, channel_id, created_at FROM tickets
-        WHERE is_active = 1
+        WHERE guild_id = ? AND is_active = 1
         ORDER BY created_at DESC
-    ''')
+    ''', (ctx.guild.id,))
 
     tickets = cursor.fetchall()
     conn.close()
@@ -599,7 +2152,7 @@ async def list_tickets(ctx):
         except discord.NotFound:
             username = f"Unknown User ({user_id})"
         except Exception as e:
-            print(f"Error fetching user {user_id}: {e}")
+            log.warning(f"Error fetching user {user_id}: {e}", extra={"event": "user_lookup_failed", "user_id": user_id})
             username = f"Unknown User ({user_id})"
 
         embed.add_field(
@@ -611,7 +2164,7 @@ async def list_tickets(ctx):
     await ctx.send(embed=embed)
 
 @bot.command(name='adduser')
-@commands.has_permissions(manage_messages=True)
+@is_staff()
 async def add_user_to_ticket(ctx, user: discord.Member = None):
     """Add a user to the current support ticket"""
     if not user:
@@ -642,12 +2195,12 @@ async def add_user_to_ticket(ctx, user: discord.Member = None):
             )
             await user.send(embed=embed)
         except discord.Forbidden:
-            print(f"Could not send notification to user {user.id}")
+            log.warning(f"Could not send notification to user {user.id}", extra={"event": "membership_notify_forbidden", "ticket_id": ticket_id, "user_id": user.id})
     else:
         await ctx.send(f"❌ {user.mention} is already in this ticket.")
 
 @bot.command(name='removeuser')
-@commands.has_permissions(manage_messages=True)
+@is_staff()
 async def remove_user_from_ticket(ctx, user: discord.Member = None):
     """Remove a user from the current support ticket"""
     if not user:
@@ -682,10 +2235,10 @@ async def remove_user_from_ticket(ctx, user: discord.Member = None):
         )
         await user.send(embed=embed)
     except discord.Forbidden:
-        print(f"Could not send notification to user {user.id}")
+        log.warning(f"Could not send notification to user {user.id}", extra={"event": "membership_notify_forbidden", "ticket_id": ticket_id, "user_id": user.id})
 
 @bot.command(name='ticketinfo')
-@commands.has_permissions(manage_messages=True)
+@is_staff()
 async def ticket_info(ctx):
     """Show information about the current ticket"""
     ticket = db.get_ticket_by_channel(ctx.channel.id)
@@ -709,7 +2262,7 @@ async def ticket_info(ctx):
     except discord.NotFound:
         original_username = f"Unknown User ({original_user_id})"
     except Exception as e:
-        print(f"Error fetching user {original_user_id}: {e}")
+        log.warning(f"Error fetching user {original_user_id}: {e}", extra={"event": "user_lookup_failed", "ticket_id": ticket_id, "user_id": original_user_id})
         original_username = f"Unknown User ({original_user_id})"
 
     embed.add_field(name="Original User", value=f"{original_username} ({original_user_id})", inline=False)
@@ -723,7 +2276,7 @@ async def ticket_info(ctx):
         except discord.NotFound:
             username = f"Unknown User ({user_id})"
         except Exception as e:
-            print(f"Error fetching user {user_id}: {e}")
+            log.warning(f"Error fetching user {user_id}: {e}", extra={"event": "user_lookup_failed", "ticket_id": ticket_id, "user_id": user_id})
             username = f"Unknown User ({user_id})"
         users_text.append(f"• {username} ({user_id})")
 
@@ -732,15 +2285,259 @@ async def ticket_info(ctx):
 
     await ctx.send(embed=embed)
 
+@bot.command(name='config')
+@commands.has_permissions(administrator=True)
+async def show_config(ctx):
+    """Show this server's mod mail configuration"""
+    guild_config = guild_configs.get(ctx.guild.id)
+    if not guild_config:
+        await ctx.send("This server is not configured yet. Start with `setcategory`.")
+        return
+
+    embed = discord.Embed(
+        title="Mod Mail Configuration",
+        color=0x0099ff,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    category_id = guild_config['support_category_id']
+    staff_role_id = guild_config['staff_role_id']
+    embed.add_field(name="Support Category", value=f"<#{category_id}>" if category_id else "Not set", inline=False)
+    embed.add_field(name="Staff Role", value=f"<@&{staff_role_id}>" if staff_role_id else "Not set", inline=False)
+    embed.add_field(name="Greeting", value=guild_config['greeting'] or "Default", inline=False)
+    embed.add_field(name="Open Ticket Limit", value=guild_config['max_open_tickets'] or "Unlimited", inline=False)
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='setcategory')
+@commands.has_permissions(administrator=True)
+async def set_category(ctx, category: discord.CategoryChannel):
+    """Set the category new ticket channels are created in"""
+    guild_configs.update(ctx.guild.id, support_category_id=category.id)
+    await ctx.send(f"✅ Tickets will be created in **{category.name}**.")
+
+@bot.command(name='setstaffrole')
+@commands.has_permissions(administrator=True)
+async def set_staff_role(ctx, role: discord.Role = None):
+    """Set (or clear) the role allowed to use staff commands"""
+    guild_configs.update(ctx.guild.id, staff_role_id=role.id if role else None)
+    await ctx.send(f"✅ Staff role set to {role.mention}." if role else "✅ Staff role cleared.")
+
+@bot.command(name='setgreeting')
+@commands.has_permissions(administrator=True)
+async def set_greeting(ctx, *, greeting: str = None):
+    """Set (or reset) the message users get when their ticket is created"""
+    guild_configs.update(ctx.guild.id, greeting=greeting)
+    await ctx.send("✅ Greeting updated." if greeting else "✅ Greeting reset to the default.")
+
+@bot.command(name='setlimit')
+@commands.has_permissions(administrator=True)
+async def set_limit(ctx, max_open_tickets: int):
+    """Set the maximum number of open tickets (0 for unlimited)"""
+    if max_open_tickets < 0:
+        await ctx.send("The limit must be 0 (unlimited) or more.")
+        return
+
+    guild_configs.update(ctx.guild.id, max_open_tickets=max_open_tickets)
+    await ctx.send(f"✅ Open ticket limit set to {max_open_tickets or 'unlimited'}.")
+
+@bot.command(name='shards')
+@commands.has_permissions(administrator=True)
+async def list_shards(ctx):
+    """Show event throughput and latency for every shard in the cluster"""
+    shard_stats.flush()
+    stats = db.get_shard_stats()
+
+    embed = discord.Embed(
+        title="Shards",
+        description=f"Shard count: {bot.shard_count or 1}",
+        color=0x0099ff,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    for shard_id, process_id, events, events_per_second, latency_ms, updated_at in stats[:25]:
+        latency = f"{latency_ms:.0f}ms" if latency_ms is not None else "n/a"
+        embed.add_field(
+            name=f"Shard {shard_id}" + (" (this server)" if ctx.guild and ctx.guild.shard_id == shard_id else ""),
+            value=(
+                f"Process: {process_id} | Events: {events} ({events_per_second:.2f}/s)\n"
+                f"Latency: {latency} | Updated: {updated_at}"
+            ),
+            inline=False
+        )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='backup')
+@commands.is_owner()
+async def backup_database(ctx):
+    """Take an online backup of the database now"""
+    await ctx.send("Backing up the database...")
+    path = await backup_manager.backup()
+    await ctx.send(f"✅ Backup written to `{os.path.basename(path)}` in {backup_manager.last_duration * 1000:.0f}ms.")
+
+@bot.command(name='backups')
+@commands.is_owner()
+async def list_backups(ctx):
+    """List database backups and the last backup's duration"""
+    backups = backup_manager.list_backups()
+
+    embed = discord.Embed(
+        title="Database Backups",
+        description="\n".join(f"`{name}`" for name in backups[:20]) or "No backups yet.",
+        color=0x0099ff,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    if backup_manager.last_duration is not None:
+        embed.add_field(
+            name="Last Backup",
+            value=(
+                f"Taken: {backup_manager.last_backup_at:%Y-%m-%d %H:%M:%S} UTC\n"
+                f"Duration: {backup_manager.last_duration * 1000:.0f}ms | Size: {backup_manager.last_size / 1024:.0f} KiB"
+            ),
+            inline=False
+        )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='restore')
+@commands.is_owner()
+async def restore_database(ctx, name: str):
+    """Restore the database from a backup (see !backups)"""
+    try:
+        await backup_manager.restore(name)
+    except FileNotFoundError:
+        await ctx.send(f"No backup named `{name}`. Use `backups` to list them.")
+        return
+
+    # Cached configuration came from the old database; other cluster processes notice the new version
+    guild_configs.load()
+    await ctx.send(f"✅ Restored the database from `{name}`. The previous state was backed up first.")
+
+@bot.command(name='looplag')
+@commands.has_permissions(administrator=True)
+async def loop_lag(ctx):
+    """Show event loop lag and the handlers that blocked it the most"""
+    if not watchdog:
+        await ctx.send("The event loop watchdog is disabled. Set `LOOP_WATCHDOG_THRESHOLD_MS` to enable it.")
+        return
+
+    embed = discord.Embed(
+        title="Event Loop Lag",
+        description=(
+            f"Last lag: {watchdog.last_lag * 1000:.1f}ms\n"
+            f"Max lag: {watchdog.max_lag * 1000:.1f}ms\n"
+            f"Stalls over {watchdog_threshold_ms}ms: {watchdog.stalls}"
+        ),
+        color=0x0099ff,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    for where, entry in watchdog.worst_offenders():
+        # Show the innermost lines of the worst stack, which is where the blocking call is
+        stack_tail = "\n".join(entry["stack"].strip().splitlines()[-4:]) or "No stack captured"
+        embed.add_field(
+            name=f"{where}",
+            value=(
+                f"Stalls: {entry['count']} | Total: {entry['total'] * 1000:.0f}ms | Max: {entry['max'] * 1000:.0f}ms\n"
+                f"```{stack_tail[-900:]}```"
+            ),
+            inline=False
+        )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='profile')
+@commands.is_owner()
+async def profile(ctx, seconds: int = 30, mode: str = 'sample'):
+    """Profile the running bot for N seconds (mode: sample or cprofile)"""
+    if mode not in ('sample', 'cprofile'):
+        await ctx.send("Mode must be `sample` or `cprofile`.")
+        return
+
+    if not 1 <= seconds <= 600:
+        await ctx.send("Duration must be between 1 and 600 seconds.")
+        return
+
+    if profile_lock.locked():
+        await ctx.send("A profiling session is already running.")
+        return
+
+    async with profile_lock:
+        os.makedirs(profile_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+        await ctx.send(f"Profiling for {seconds}s ({mode})...")
+
+        if mode == 'sample':
+            # Sample the event loop thread from a background thread
+            path = os.path.join(profile_dir, f"profile-{stamp}.folded")
+            profiler = SamplingProfiler(threading.get_ident())
+            profiler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                await asyncio.to_thread(profiler.stop)
+            await asyncio.to_thread(profiler.write, path)
+        else:
+            # cProfile traces the thread it is enabled on, which is the event loop thread
+            path = os.path.join(profile_dir, f"profile-{stamp}.pstats")
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+            await asyncio.to_thread(profiler.dump_stats, path)
+
+    log.info(f"Wrote {mode} profile to {path}", extra={"event": "profile_written", "path": path})
+    await ctx.send(f"Profile written to `{path}`.")
+
+@bot.command(name='cmdstats')
+@commands.is_owner()
+async def command_stats(ctx):
+    """Show time spent in each command handler"""
+    if not command_timings:
+        await ctx.send("No commands have been timed yet.")
+        return
+
+    embed = discord.Embed(
+        title="Command Timings",
+        color=0x0099ff,
+        timestamp=datetime.now(timezone.utc)
+    )
+
+    ranked = sorted(command_timings.items(), key=lambda item: item[1]["total"], reverse=True)
+    for name, entry in ranked[:25]:
+        embed.add_field(
+            name=name,
+            value=(
+                f"Calls: {entry['count']} | Avg: {entry['total'] / entry['count'] * 1000:.1f}ms | "
+                f"Max: {entry['max'] * 1000:.1f}ms"
+            ),
+            inline=False
+        )
+
+    await ctx.send(embed=embed)
+
 if __name__ == "__main__":
     # Check if required environment variables are set
     if not os.getenv('DISCORD_TOKEN'):
-        print("Error: DISCORD_TOKEN not found in environment variables")
+        log.error("DISCORD_TOKEN not found in environment variables")
         exit(1)
 
-    if not os.getenv('SUPPORT_TICKET_PARENT'):
-        print("Error: SUPPORT_TICKET_PARENT not found in environment variables")
-        exit(1)
+    async def main():
+        try:
+            async with bot:
+                await bot.start(os.getenv('DISCORD_TOKEN'))
+        finally:
+            # Close the attachment download session along with the bot
+            if attachment_store:
+                await attachment_store.close()
 
     # Run the bot
-    bot.run(os.getenv('DISCORD_TOKEN'))
+    # Logging is already configured above, so discord.py's own handler isn't installed
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Cluster launcher for Discord Mod Mail Bot
+
+Runs bot.py as several processes, each owning a contiguous range of shards.
+The processes share ticket state and configuration through the SQLite
+database, so they must all point at the same DATABASE_PATH.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from dotenv import load_dotenv
+from structured_logging import setup_logging
+
+log = logging.getLogger('modmail.cluster')
+
+def get_recommended_shard_count(token):
+    """Ask Discord how many shards the bot should use"""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "discord-mod-mail cluster launcher"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+def split_shards(shard_count, process_count):
+    """Split shard IDs into contiguous ranges, one per process"""
+    process_count = max(1, min(process_count, shard_count))
+    base, extra = divmod(shard_count, process_count)
+
+    ranges = []
+    start = 0
+    for index in range(process_count):
+        size = base + (1 if index < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+
+    return ranges
+
+def start_process(cluster_id, shard_ids, shard_count):
+    """Start one bot process for a range of shards"""
+    env = dict(os.environ)
+    env["CLUSTER_ID"] = str(cluster_id)
+    env["SHARD_IDS"] = ",".join(str(shard_id) for shard_id in shard_ids)
+    env["SHARD_COUNT"] = str(shard_count)
+
+    log.info(
+        f"Starting cluster {cluster_id} with shards {env['SHARD_IDS']} of {shard_count}",
+        extra={"event": "cluster_starting", "cluster_id": cluster_id, "shard_ids": shard_ids, "shard_count": shard_count}
+    )
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")], env=env)
+
+def run_cluster(shard_count, process_count):
+    """Run and supervise the bot processes until interrupted"""
+    shard_ranges = split_shards(shard_count, process_count)
+    processes = {
+        cluster_id: start_process(cluster_id, shard_ids, shard_count)
+        for cluster_id, shard_ids in enumerate(shard_ranges)
+    }
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while processes:
+        time.sleep(1)
+        for cluster_id, process in list(processes.items()):
+            if process.poll() is None:
+                continue
+
+            if stopping:
+                del processes[cluster_id]
+                continue
+
+            # Restart crashed processes after a short delay
+            log.warning(
+                f"Cluster {cluster_id} exited with code {process.returncode}, restarting...",
+                extra={"event": "cluster_restarting", "cluster_id": cluster_id, "exit_code": process.returncode}
+            )
+            time.sleep(5)
+            processes[cluster_id] = start_process(cluster_id, shard_ranges[cluster_id], shard_count)
+
+    log.info("All clusters stopped.", extra={"event": "cluster_stopped"})
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Run the mod mail bot as a multi-process shard cluster")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("CLUSTER_PROCESSES", "2")), help="number of bot processes")
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")), help="total shard count (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    if not os.getenv("DISCORD_TOKEN"):
+        log.error("DISCORD_TOKEN not found in environment variables")
+        exit(1)
+
+    shard_count = args.shards or get_recommended_shard_count(os.getenv("DISCORD_TOKEN"))
+    run_cluster(shard_count, args.processes)
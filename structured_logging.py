@@ -0,0 +1,241 @@
+"""
+Structured logging for Discord Mod Mail Bot
+
+Every process (bot.py and cluster.py) logs one JSON object per line to
+stdout through a queue, so writing logs never blocks the caller. Repeated
+records and storms of one event are dropped and summarised.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+STANDARD_LOG_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON, including fields passed through `extra`"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        # Context such as event, ticket_id and user_id
+        for key, value in vars(record).items():
+            if key not in STANDARD_LOG_FIELDS:
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+
+        return json.dumps(entry, default=str)
+
+def summary_record(record, message, fields):
+    """Build a record reporting dropped logs, at the level and location of `record`"""
+    summary = logging.LogRecord(record.name, record.levelno, record.pathname, record.lineno, message, None, None)
+    for key, value in fields.items():
+        setattr(summary, key, value)
+    return summary
+
+class SummarisingFilter(logging.Filter):
+    """Base for filters that drop records and periodically emit a summary of what they dropped"""
+
+    def __init__(self, interval, emit=None):
+        super().__init__()
+        self.interval = interval
+        self.emit = emit
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def flush(self, now=None):
+        raise NotImplementedError
+
+    def start(self):
+        """Flush summaries on a background thread so quiet periods still report them"""
+        if self.interval <= 0:
+            return
+
+        def run():
+            while not self._stop.wait(self.interval):
+                self.flush()
+
+        threading.Thread(target=run, name=f"log-{type(self).__name__}", daemon=True).start()
+
+    def stop(self):
+        """Stop the flush thread and report whatever is still pending"""
+        self._stop.set()
+        self.flush(float('inf'))
+
+class DuplicateFilter(SummarisingFilter):
+    """Suppress identical records within a time window and summarise what was dropped"""
+
+    def __init__(self, window, emit=None):
+        super().__init__(window, emit)
+        self.window = window
+        self._seen = {}
+
+    def filter(self, record):
+        if self.window <= 0:
+            return True
+
+        # Only the same rendered message about the same ticket and user counts as a duplicate
+        key = (
+            record.name,
+            record.levelno,
+            record.getMessage(),
+            getattr(record, 'ticket_id', None),
+            getattr(record, 'user_id', None),
+        )
+        now = time.monotonic()
+
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen and now - seen[0] < self.window:
+                seen[1] += 1
+                return False
+
+        # The previous window for this key is over, so report it before letting the record through
+        self.flush(now)
+        with self._lock:
+            self._seen[key] = [now, 0, record]
+
+        return True
+
+    def flush(self, now=None):
+        """Emit a summary for every window that has ended with suppressed duplicates"""
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            expired = [key for key, (first_seen, _, _) in self._seen.items() if now - first_seen >= self.window]
+            summaries = [self._seen.pop(key) for key in expired]
+
+        for _, suppressed, record in summaries:
+            if suppressed and self.emit:
+                self.emit(self.summarise(record, suppressed))
+
+    def summarise(self, record, suppressed):
+        """Build a record reporting how many duplicates of `record` were dropped"""
+        fields = {key: value for key, value in vars(record).items() if key not in STANDARD_LOG_FIELDS}
+        fields['suppressed'] = suppressed
+        return summary_record(record, f"Suppressed {suppressed} duplicates of: {record.getMessage()}", fields)
+
+class EventRateLimiter(SummarisingFilter):
+    """Token bucket per (logger, event), so a storm of distinct records about one event is capped"""
+
+    def __init__(self, rate, burst, interval, emit=None):
+        super().__init__(interval, emit)
+        self.rate = rate
+        self.burst = burst
+        # (logger, event) -> [tokens, last refill, dropped, last dropped record]
+        self._buckets = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if self.rate <= 0 or event is None:
+            return True
+
+        key = (record.name, event)
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.setdefault(key, [self.burst, now, 0, None])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+
+            bucket[2] += 1
+            bucket[3] = record
+            return False
+
+    def flush(self, now=None):
+        """Emit one summary per event that had records dropped since the last flush"""
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            summaries = []
+            for key, bucket in list(self._buckets.items()):
+                if bucket[2]:
+                    summaries.append((key[1], bucket[2], bucket[3]))
+                    bucket[2], bucket[3] = 0, None
+                elif bucket[0] + (now - bucket[1]) * self.rate >= self.burst:
+                    # Full and idle, so it can be recreated on demand
+                    del self._buckets[key]
+
+        for event, dropped, record in summaries:
+            if self.emit:
+                self.emit(summary_record(
+                    record,
+                    f"Rate limited {dropped} '{event}' records",
+                    {'event': event, 'suppressed': dropped, 'rate_limited': True}
+                ))
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them so the listener thread does the work"""
+
+    def prepare(self, record):
+        # Only merge the arguments now, in case they are mutated after logging
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging():
+    """Route all logging through a queue to a JSON handler on a background thread"""
+    log_queue = queue.Queue(-1)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = DeferredQueueHandler(log_queue)
+
+    # Summaries bypass the filter and go straight onto the queue
+    duplicate_filter = DuplicateFilter(
+        float(os.getenv('LOG_DUPLICATE_WINDOW', '10')),
+        emit=lambda record: queue_handler.enqueue(queue_handler.prepare(record))
+    )
+    # Duplicates are dropped first so they don't use up their event's rate limit
+    rate_limiter = EventRateLimiter(
+        float(os.getenv('LOG_EVENT_RATE', '5')),
+        float(os.getenv('LOG_EVENT_BURST', '20')),
+        interval=float(os.getenv('LOG_DUPLICATE_WINDOW', '10')) or 10,
+        emit=duplicate_filter.emit
+    )
+
+    for summarising_filter in (duplicate_filter, rate_limiter):
+        queue_handler.addFilter(summarising_filter)
+        summarising_filter.start()
+        # atexit runs in reverse order, so pending summaries are queued before the listener stops
+        atexit.register(summarising_filter.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    # Per-module levels, e.g. LOG_LEVELS=discord=WARNING,modmail.watchdog=DEBUG
+    for spec in os.getenv('LOG_LEVELS', '').split(','):
+        name, _, level = spec.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    return listener
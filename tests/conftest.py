@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# bot.py opens its database at import time, so point it somewhere disposable first
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'modmail.db'))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+@pytest.fixture
+def database(tmp_path):
+    """A fresh ModMailDatabase in a temporary directory"""
+    return bot.ModMailDatabase(str(tmp_path / 'modmail.db'))
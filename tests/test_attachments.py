@@ -0,0 +1,102 @@
+import os
+import tempfile
+import threading
+
+import bot
+
+def make_store(database, tmp_path, quota_bytes):
+    return bot.AttachmentStore(database, str(tmp_path / 'attachments'), quota_bytes=quota_bytes, max_file_bytes=1024)
+
+def store_file(store, sha256, size):
+    os.makedirs(store.root, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=store.root, prefix='.incoming-')
+    os.close(fd)
+    with open(temp_path, 'wb') as f:
+        f.write(b'x' * size)
+    store._store(temp_path, sha256, size, 'text/plain')
+
+def test_usage_is_tracked_without_rescanning(database, tmp_path):
+    store = make_store(database, tmp_path, quota_bytes=250)
+    store_file(store, 'aa' * 32, 100)
+    store_file(store, 'bb' * 32, 100)
+    # Storing the same content again doesn't count twice
+    store_file(store, 'aa' * 32, 100)
+
+    assert store.usage == 200
+    assert database.get_stored_attachment_usage() == 200
+
+def test_enforce_quota_evicts_least_recently_used(database, tmp_path):
+    store = make_store(database, tmp_path, quota_bytes=250)
+    for sha256 in ('aa' * 32, 'bb' * 32, 'cc' * 32):
+        store_file(store, sha256, 100)
+
+    store.enforce_quota()
+
+    assert store.usage == 200
+    assert not os.path.exists(store.path_for('aa' * 32))
+    assert os.path.exists(store.path_for('cc' * 32))
+    assert database.get_stored_attachment_usage() == 200
+
+def test_store_and_evict_stay_consistent(database, tmp_path):
+    store = make_store(database, tmp_path, quota_bytes=300)
+    hashes = [f'{index:064x}' for index in range(40)]
+
+    def writer():
+        for sha256 in hashes:
+            store_file(store, sha256, 100)
+
+    def evictor():
+        for _ in hashes:
+            store.enforce_quota()
+
+    threads = [threading.Thread(target=writer), threading.Thread(target=evictor)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every row marked stored still has its file on disk, and the running total matches
+    for sha256, _ in database.get_stored_attachments():
+        assert os.path.exists(store.path_for(sha256))
+    assert store.usage == database.get_stored_attachment_usage()
+
+def test_stores_sharing_a_database_enforce_one_quota(database, tmp_path):
+    # Two cluster processes archiving into the same directory and database
+    first = make_store(database, tmp_path, quota_bytes=250)
+    second = make_store(bot.ModMailDatabase(database.db_path), tmp_path, quota_bytes=250)
+
+    store_file(first, 'aa' * 32, 100)
+    store_file(second, 'bb' * 32, 100)
+    store_file(first, 'cc' * 32, 100)
+    store_file(second, 'dd' * 32, 100)
+
+    # Each store sees what the other wrote
+    assert first.usage == second.usage == 400
+
+    second.enforce_quota()
+
+    assert first.usage == 200
+    assert database.get_stored_attachment_usage() == 200
+    assert not os.path.exists(first.path_for('aa' * 32))
+    assert not os.path.exists(first.path_for('bb' * 32))
+    assert os.path.exists(first.path_for('dd' * 32))
+
+def test_stores_sharing_a_database_stay_consistent(database, tmp_path):
+    stores = [make_store(bot.ModMailDatabase(database.db_path), tmp_path, quota_bytes=300) for _ in range(2)]
+    # Both stores archive the same content, as when staff in two processes send one screenshot
+    hashes = [f'{index:064x}' for index in range(30)]
+
+    def writer(store):
+        for sha256 in hashes:
+            store_file(store, sha256, 100)
+            store.enforce_quota()
+
+    threads = [threading.Thread(target=writer, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for sha256, _ in database.get_stored_attachments():
+        assert os.path.exists(stores[0].path_for(sha256))
+    assert stores[0].usage == database.get_stored_attachment_usage() <= 300
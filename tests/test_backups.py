@@ -0,0 +1,24 @@
+import asyncio
+import os
+
+import bot
+
+def test_restore_moves_config_version_past_other_caches(database, tmp_path):
+    manager = bot.BackupManager(database, str(tmp_path / 'backups'), keep=7, compress=False)
+    writer = bot.GuildConfigCache(database)
+    reader = bot.GuildConfigCache(database)
+
+    writer.update(1, support_category_id=100)
+    writer.update(1, support_category_id=200)
+    name = os.path.basename(asyncio.run(manager.backup()))
+    writer.update(1, support_category_id=300)
+    reader.load()
+    assert reader.for_category(300)
+
+    asyncio.run(manager.restore(name))
+
+    # The restored version is one behind the reader's, so bumping it by one would match and hide the restore
+    assert database.get_config_version() > reader.version
+    assert reader.refresh_if_changed()
+    assert reader.get(1)['support_category_id'] == 200
+    assert not reader.refresh_if_changed()
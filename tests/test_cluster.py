@@ -0,0 +1,81 @@
+import os
+import sqlite3
+
+import bot
+from cluster import split_shards
+
+def test_split_shards_even():
+    assert split_shards(4, 2) == [[0, 1], [2, 3]]
+
+def test_split_shards_uneven():
+    assert split_shards(5, 2) == [[0, 1, 2], [3, 4]]
+
+def test_split_shards_more_processes_than_shards():
+    assert split_shards(2, 5) == [[0], [1]]
+
+def test_split_shards_covers_every_shard_once():
+    ranges = split_shards(17, 4)
+    assert [shard_id for shard_ids in ranges for shard_id in shard_ids] == list(range(17))
+
+def test_config_change_propagates_between_caches(database):
+    writer = bot.GuildConfigCache(database)
+    reader = bot.GuildConfigCache(database)
+    writer.load()
+    reader.load()
+
+    assert not reader.refresh_if_changed()
+
+    writer.update(1, support_category_id=100)
+
+    assert reader.get(1) is None
+    assert reader.refresh_if_changed()
+    assert reader.get(1)['support_category_id'] == 100
+    assert reader.for_category(100)['guild_id'] == 1
+    assert not reader.refresh_if_changed()
+
+def test_shard_stats_flush(database):
+    stats = bot.ShardStats(database)
+    for _ in range(3):
+        stats.record(0)
+
+    flushed = stats.flush()
+    assert flushed[0][0] == 3
+    assert flushed[0][1] > 0
+
+    stored = {row[0]: row for row in database.get_shard_stats()}
+    assert stored[0][1] == os.getpid()
+    assert stored[0][2] == 3
+
+    # A flush with no new events reports the same total and no rate
+    flushed = stats.flush()
+    assert flushed[0][0] == 3
+    assert flushed[0][1] == 0
+
+def test_shard_stats_count_gateway_sequence(database, monkeypatch):
+    sequences = {0: 10, 1: None}
+    monkeypatch.setattr(bot, 'gateway_sequences', lambda: dict(sequences))
+    stats = bot.ShardStats(database)
+
+    assert stats.flush()[0][0] == 10
+
+    sequences[0] = 25
+    sequences[1] = 4
+    flushed = stats.flush()
+    assert flushed[0][0] == 25
+    assert flushed[1][0] == 4
+
+    # A new session restarts the sequence, and its events are added on top
+    sequences[0] = 3
+    assert stats.flush()[0][0] == 28
+
+def test_stale_shard_stats_are_removed(database):
+    # A shard from an old cluster layout that no process updates any more
+    database.save_shard_stats(1, {7: (100, 1.0, 50.0)})
+    conn = sqlite3.connect(database.db_path)
+    conn.execute("UPDATE shard_stats SET updated_at = datetime('now', '-1 hour') WHERE shard_id = 7")
+    conn.commit()
+    conn.close()
+
+    bot.ShardStats(database, stale_after=60).flush()
+
+    assert [row[0] for row in database.get_shard_stats()] == [0]
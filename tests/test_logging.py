@@ -0,0 +1,79 @@
+import json
+import logging
+import sys
+
+import structured_logging
+
+def make_record(message, level=logging.WARNING, **extra):
+    record = logging.LogRecord('modmail', level, __file__, 1, message, None, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+def test_json_formatter_includes_extra_fields():
+    record = make_record("Could not send message to user 1", event='relay_forbidden', ticket_id=7, user_id=1)
+
+    entry = json.loads(structured_logging.JsonFormatter().format(record))
+
+    assert entry['level'] == 'WARNING'
+    assert entry['logger'] == 'modmail'
+    assert entry['message'] == "Could not send message to user 1"
+    assert (entry['event'], entry['ticket_id'], entry['user_id']) == ('relay_forbidden', 7, 1)
+
+def test_json_formatter_includes_exception():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record("Failed")
+        record.exc_info = sys.exc_info()
+
+    entry = json.loads(structured_logging.JsonFormatter().format(record))
+
+    assert "ValueError: boom" in entry['exception']
+
+def test_duplicate_filter_drops_only_exact_duplicates():
+    duplicate_filter = structured_logging.DuplicateFilter(60)
+
+    assert duplicate_filter.filter(make_record("Could not send message to user 1", user_id=1))
+    assert not duplicate_filter.filter(make_record("Could not send message to user 1", user_id=1))
+    assert duplicate_filter.filter(make_record("Could not send message to user 2", user_id=2))
+    assert duplicate_filter.filter(make_record("Could not send message to user 1", user_id=1, ticket_id=3))
+
+def test_duplicate_filter_summarises_when_window_ends():
+    summaries = []
+    duplicate_filter = structured_logging.DuplicateFilter(60, emit=summaries.append)
+
+    for _ in range(4):
+        duplicate_filter.filter(make_record("Shard 0 reconnected", event='shard_resumed'))
+
+    duplicate_filter.flush()
+    assert summaries == []
+
+    duplicate_filter.stop()
+    assert len(summaries) == 1
+    assert summaries[0].getMessage() == "Suppressed 3 duplicates of: Shard 0 reconnected"
+    assert summaries[0].suppressed == 3
+    assert summaries[0].event == 'shard_resumed'
+
+def test_rate_limiter_caps_distinct_records_of_one_event():
+    summaries = []
+    rate_limiter = structured_logging.EventRateLimiter(rate=0.001, burst=5, interval=10, emit=summaries.append)
+
+    passed = [
+        rate_limiter.filter(make_record(f"Could not send message to user {user_id}", event='relay_forbidden', user_id=user_id))
+        for user_id in range(50)
+    ]
+
+    assert sum(passed) == 5
+    # Other events and records without an event have their own budget
+    assert rate_limiter.filter(make_record("Ticket closed", event='ticket_closed'))
+    assert rate_limiter.filter(make_record("No event"))
+
+    rate_limiter.flush()
+    assert len(summaries) == 1
+    assert summaries[0].suppressed == 45
+    assert summaries[0].event == 'relay_forbidden'
+
+    # Nothing new was dropped, so there is nothing more to report
+    rate_limiter.flush()
+    assert len(summaries) == 1
@@ -0,0 +1,75 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import bot
+
+def get_revisions(database, message_row_id):
+    conn = sqlite3.connect(database.db_path)
+    rows = conn.execute(
+        'SELECT revision_type, content FROM message_revisions WHERE message_row_id = ? ORDER BY id',
+        (message_row_id,)
+    ).fetchall()
+    conn.close()
+    return rows
+
+@pytest.fixture
+def relayed(database, monkeypatch):
+    """A user DM (source message 500) relayed to two ticket channel copies"""
+    monkeypatch.setattr(bot, 'db', database)
+    monkeypatch.setattr(bot.bot._connection, 'user', SimpleNamespace(id=1))
+
+    # The copies are gone from Discord, so only the database side of a sync runs
+    class MissingChannel:
+        async def fetch_message(self, message_id):
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+
+        def get_partial_message(self, message_id):
+            return SimpleNamespace(fetch=lambda: self.fetch_message(message_id))
+
+    monkeypatch.setattr(bot.bot, 'get_partial_messageable', lambda channel_id: MissingChannel())
+
+    ticket_id = database.create_ticket(42, 100, 1)
+    message_row_id = database.add_message(ticket_id, 900, 42, "Hello", True)
+    database.add_message_relays(ticket_id, message_row_id, 500, [(100, 900), (101, 901)])
+    return message_row_id
+
+def test_source_maps_to_every_copy(database, relayed):
+    message_row_id, is_from_user, relays = database.get_message_relays(500)
+
+    assert message_row_id == relayed
+    assert is_from_user
+    assert sorted(relays) == [(100, 900), (101, 901)]
+    # Relayed copies are not sources themselves
+    assert database.get_message_relays(900) is None
+
+def test_repeated_identical_edits_add_one_revision(database, relayed):
+    for _ in range(3):
+        asyncio.run(bot.sync_message_edit(500, 10, None, 42, "Hello again"))
+    # Editing back to the original text is a real change
+    asyncio.run(bot.sync_message_edit(500, 10, None, 42, "Hello"))
+
+    assert get_revisions(database, relayed) == [('edit', "Hello again"), ('edit', "Hello")]
+    assert database.get_latest_message_content(relayed) == "Hello"
+
+def test_unchanged_edit_adds_no_revision(database, relayed):
+    asyncio.run(bot.sync_message_edit(500, 10, None, 42, "Hello"))
+
+    assert get_revisions(database, relayed) == []
+
+def test_delete_records_revision(database, relayed):
+    asyncio.run(bot.sync_message_delete(500, 10, None))
+
+    assert get_revisions(database, relayed) == [('delete', None)]
+    # Deleting keeps the last known content
+    assert database.get_latest_message_content(relayed) == "Hello"
+
+def test_bulk_delete_syncs_every_message(database, relayed):
+    payload = SimpleNamespace(message_ids={500, 12345}, channel_id=10, guild_id=None)
+
+    asyncio.run(bot.on_raw_bulk_message_delete(payload))
+
+    assert get_revisions(database, relayed) == [('delete', None)]